@@ -2,6 +2,10 @@ import uvicorn
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import ollama
+import emotion
+import moderation
+import cache
+import context
 from typing import List, Dict, Optional
 
 app = FastAPI()
@@ -27,10 +31,36 @@ chat_history_store: Dict[str, List[Dict[str, str]]] = {}
 
 MODEL_NAME = "llama3.2"
 
+# 返答生成に渡す履歴のトークン予算（システムプロンプトを除く）
+CONTEXT_TOKEN_BUDGET = 2048
+
+# 表情スコアの算出方法（"llm" / "local" / "hybrid"：ローカル推定で自信がない時だけ LLM）
+EMOTION_SCORER = "hybrid"
+
+# モデレーション・表情スコアの LLM 判定結果キャッシュ
+#  ※ プロンプトを変更したら *_PROMPT_VERSION を上げて古い結果を使わないようにする
+MODERATION_PROMPT_VERSION = 1
+EMOTION_PROMPT_VERSION = 1
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 60 * 60
+
+moderation_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+emotion_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+
 def check_input_validity(text: str) -> bool:
     """
     入力文書が会話として適切かを評価する (True: 適切, False: 不適切)
+    明らかな入力はローカルの事前チェックで確定させ、LLM 呼び出しを省く
     """
+    verdict = moderation.prefilter(text)
+    if verdict is not None:
+        return verdict
+
+    cache_key = cache.make_key(MODEL_NAME, MODERATION_PROMPT_VERSION, text)
+    cached = moderation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     You are a content moderator. Analyze the following user input.
     If it contains offensive content, nonsense, or is completely inappropriate for a chat, reply with "INVALID".
@@ -42,7 +72,9 @@ def check_input_validity(text: str) -> bool:
     try:
         response = ollama.chat(model=MODEL_NAME, messages=[{'role': 'user', 'content': prompt}])
         content = response['message']['content'].strip().upper()
-        return "VALID" in content
+        is_valid = "VALID" in content and "INVALID" not in content
+        moderation_cache.put(cache_key, is_valid)
+        return is_valid
     except Exception as e:
         print(f"Validation Error: {e}")
         return True # エラー時は一旦通す安全策
@@ -67,7 +99,23 @@ def generate_ai_response(history: List[Dict[str, str]]) -> str:
 def evaluate_emotion(text: str) -> int:
     """
     回答テキストに基づいて表情用スコア(0-15)を生成する
+    EMOTION_SCORER の設定に従ってローカル推定と LLM を使い分ける
+    """
+    if EMOTION_SCORER != "llm":
+        score, confident = emotion.score_emotion(text)
+        if EMOTION_SCORER == "local" or confident:
+            return score
+    return evaluate_emotion_llm(text)
+
+def evaluate_emotion_llm(text: str) -> int:
     """
+    回答テキストに基づいて表情用スコア(0-15)を LLM で生成する
+    """
+    cache_key = cache.make_key(MODEL_NAME, EMOTION_PROMPT_VERSION, text)
+    cached = emotion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     Analyze the sentiment of the following text and assign an integer score from 0 to 15.
     
@@ -90,7 +138,9 @@ def evaluate_emotion(text: str) -> int:
         if match:
             score = int(match.group())
             # 0-15の範囲に収める
-            return max(0, min(15, score))
+            score = max(0, min(15, score))
+            emotion_cache.put(cache_key, score)
+            return score
         return 7 # デフォルト値（ニュートラル）
     except Exception as e:
         print(f"Emotion Error: {e}")
@@ -139,8 +189,9 @@ async def chat_endpoint(request: ChatRequest):
     chat_history_store[user_id].append({'role': 'user', 'content': user_message})
 
     # 3. AIによる回答生成 (過去履歴参照) (AI)
-    # コンテキストウィンドウ制御のため、最新の10往復程度に制限するのが一般的
-    recent_history = chat_history_store[user_id][-20:] 
+    # コンテキストウィンドウ制御のため、トークン予算に収まる直近の発言だけを渡す
+    recent_history, context_tokens = context.assemble_context(chat_history_store[user_id], CONTEXT_TOKEN_BUDGET)
+    print(f"Context: {len(recent_history)} messages, {context_tokens} tokens")
     reply_text = generate_ai_response(recent_history)
 
     # 履歴にAI回答を追加
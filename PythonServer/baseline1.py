@@ -1,17 +1,33 @@
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 import ollama
+import llm_client
+import metrics
+import tracing
+import warmup
+import emotion
+import moderation
+import cache
+import context
+from session_store import Session, SessionStore, SQLiteSessionBackend
 from typing import List, Dict
+import asyncio
 import re
 
 app = FastAPI()
 
+# リクエストごとのトレース（LLM 呼び出し・セッション操作・フォールバックをスパンとして JSONL に書き出す）
+TRACE_PATH = "traces_baseline1.jsonl"  # None なら書き出さない
+tracing.configure("baseline1", TRACE_PATH)
+app.add_middleware(tracing.TracingMiddleware)
+
 # =========================
 # 設定（回数・コンテキスト）
 # =========================
 MAX_TURNS = 10          # 返答を作成する最大回数
-CONTEXT_TURNS = 10      # コンテキストに入れる往復数（10往復）
+CONTEXT_TOKEN_BUDGET = 2048  # コンテキストに入れる履歴のトークン予算（システムプロンプトを除く）
 
 # =========================
 # モデル設定（役割ごとに分離）
@@ -20,6 +36,19 @@ MODEL_NAME_MODERATION = "llama3.2"      # 入力妥当性チェック用（変
 MODEL_NAME_REPLY      = "3.1swallow-8B" # 返答生成用
 MODEL_NAME_EMOTION    = "3.1swallow 8B" # 表情推定用（空白あってもOKにする）
 
+# 表情スコアの算出方法（"llm" / "local" / "hybrid"：ローカル推定で自信がない時だけ LLM）
+EMOTION_SCORER = "hybrid"
+
+# モデレーション・表情スコアの LLM 判定結果キャッシュ
+#  ※ プロンプトを変更したら *_PROMPT_VERSION を上げて古い結果を使わないようにする
+MODERATION_PROMPT_VERSION = 1
+EMOTION_PROMPT_VERSION = 1
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 60 * 60
+
+moderation_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+emotion_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+
 def normalize_model_name(name: str) -> str:
     """
     Ollamaのモデル名は空白なしのことが多いので、念のため正規化
@@ -28,6 +57,38 @@ def normalize_model_name(name: str) -> str:
     return name.strip().replace(" ", "-")
 
 
+async def load_model_default_host(model: str, keep_alive: str):
+    """
+    返答生成と同じ既定ホスト（同期版 ollama）にだけモデルを読み込ませる
+    （baseline1 は llm_client.OLLAMA_HOSTS の振り分けを使わないため）
+    """
+    try:
+        await asyncio.to_thread(ollama.generate, model=model, prompt="", keep_alive=keep_alive)
+    except Exception as e:
+        return {"default": e}
+    return {"default": None}
+
+
+# 起動時に 3 役割のモデルを読み込んでおく（/ready で準備状況を返す）
+model_warmer = warmup.ModelWarmer(
+    (normalize_model_name(name) for name in (MODEL_NAME_MODERATION, MODEL_NAME_REPLY, MODEL_NAME_EMOTION)),
+    loader=load_model_default_host,
+)
+
+
+def ollama_chat(**kwargs):
+    """
+    ollama.chat を呼び、トークン数をメトリクスとトレース（ollama.chat スパン）に記録する
+    """
+    kwargs.setdefault('keep_alive', llm_client.KEEP_ALIVE)
+    with tracing.span("ollama.chat", kind=tracing.KIND_CLIENT,
+                      **{"llm.model": kwargs.get('model'), "llm.role": metrics.current_stage.get()}) as span:
+        response = ollama.chat(**kwargs)
+        metrics.record_ollama(response)
+        llm_client.record_response(span, response)
+    return response
+
+
 # --- データモデル定義 ---
 
 class ChatRequest(BaseModel):
@@ -41,19 +102,40 @@ class ChatResponse(BaseModel):
     end: bool
 
 
-# --- 会話履歴管理 (簡易メモリ保存) ---
-chat_history_store: Dict[str, List[Dict[str, str]]] = {}
-turn_count_store: Dict[str, int] = {}
-end_flag_store: Dict[str, bool] = {}
+# --- 会話履歴管理 (メモリ上のセッションストア) ---
+# 件数・メモリ量の上限とアイドル時間で古いセッションを捨てる
+# SESSION_DB_PATH を指定すると SQLite にも保存し、再起動・追い出し後も会話を続けられる
+MAX_SESSIONS = 10_000
+MAX_SESSION_BYTES = 256 * 1024 * 1024
+SESSION_IDLE_TTL_SECONDS = 2 * 60 * 60
+SESSION_DB_PATH = None  # 例: "sessions.sqlite3"（None ならメモリ上のみ）
+
+session_store = SessionStore(
+    max_sessions=MAX_SESSIONS,
+    max_bytes=MAX_SESSION_BYTES,
+    idle_ttl_seconds=SESSION_IDLE_TTL_SECONDS,
+    backend=SQLiteSessionBackend(SESSION_DB_PATH) if SESSION_DB_PATH else None,
+)
 
 
 # --- LLM処理関数群 ---
 
+@metrics.staged("moderation")
 def check_input_validity(text: str) -> bool:
     """
     入力文書が会話として適切かを評価する (True: 適切, False: 不適切)
     ※ モデレーション専用モデルを使用
+    明らかな入力はローカルの事前チェックで確定させ、LLM 呼び出しを省く
     """
+    verdict = moderation.prefilter(text)
+    if verdict is not None:
+        return verdict
+
+    cache_key = cache.make_key(normalize_model_name(MODEL_NAME_MODERATION), MODERATION_PROMPT_VERSION, text)
+    cached = moderation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     You are a content moderator. Analyze the following user input.
     If it contains offensive content, nonsense, or is completely inappropriate for a chat, reply with "INVALID".
@@ -63,17 +145,21 @@ def check_input_validity(text: str) -> bool:
     Answer (VALID or INVALID):
     """
     try:
-        response = ollama.chat(
+        response = ollama_chat(
             model=normalize_model_name(MODEL_NAME_MODERATION),
             messages=[{'role': 'user', 'content': prompt}]
         )
         content = response['message']['content'].strip().upper()
-        return "VALID" in content
+        is_valid = "VALID" in content and "INVALID" not in content
+        moderation_cache.put(cache_key, is_valid)
+        return is_valid
     except Exception as e:
         print(f"Validation Error: {e}")
+        tracing.record_fallback(e, True)
         return True
 
 
+@metrics.staged("generation")
 def generate_ai_response(history: List[Dict[str, str]]) -> str:
     """
     過去の会話履歴を踏まえて回答を生成する
@@ -86,21 +172,40 @@ def generate_ai_response(history: List[Dict[str, str]]) -> str:
         }
         messages = [system_prompt] + history
         
-        response = ollama.chat(
+        response = ollama_chat(
             model=normalize_model_name(MODEL_NAME_REPLY),
             messages=messages
         )
         return response['message']['content']
     except Exception as e:
         print(f"Generate Error: {e}")
+        tracing.record_fallback(e, "申し訳ありません。エラーが発生しました。")
         return "申し訳ありません。エラーが発生しました。"
 
 
+@metrics.staged("emotion")
 def evaluate_emotion(text: str) -> int:
     """
     回答テキストに基づいて表情用スコア(0-15)を生成する
+    EMOTION_SCORER の設定に従ってローカル推定と LLM を使い分ける
+    """
+    if EMOTION_SCORER != "llm":
+        score, confident = emotion.score_emotion(text)
+        if EMOTION_SCORER == "local" or confident:
+            return score
+    return evaluate_emotion_llm(text)
+
+
+def evaluate_emotion_llm(text: str) -> int:
+    """
+    回答テキストに基づいて表情用スコア(0-15)を LLM で生成する
     ※ 表情推定専用モデルを使用
     """
+    cache_key = cache.make_key(normalize_model_name(MODEL_NAME_EMOTION), EMOTION_PROMPT_VERSION, text)
+    cached = emotion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     Analyze the sentiment of the following text and assign an integer score from 0 to 15.
     
@@ -114,7 +219,7 @@ def evaluate_emotion(text: str) -> int:
     Return ONLY the integer number. Do not explain.
     """
     try:
-        response = ollama.chat(
+        response = ollama_chat(
             model=normalize_model_name(MODEL_NAME_EMOTION),
             messages=[{'role': 'user', 'content': prompt}]
         )
@@ -122,10 +227,14 @@ def evaluate_emotion(text: str) -> int:
         match = re.search(r'\d+', content)
         if match:
             score = int(match.group())
-            return max(0, min(15, score))
+            score = max(0, min(15, score))
+            emotion_cache.put(cache_key, score)
+            return score
+        tracing.record_fallback(f"no score in {content!r}", 7)
         return 7
     except Exception as e:
         print(f"Emotion Error: {e}")
+        tracing.record_fallback(e, 7)
         return 7
 
 
@@ -147,20 +256,70 @@ def determine_state(user_text: str, ai_text: str) -> int:
 # --- APIエンドポイント ---
 
 @app.post("/chat", response_model=ChatResponse)
+@metrics.staged("turn")
 async def chat_endpoint(request: ChatRequest):
     user_id = request.user_id
     user_message = request.message
 
-    # 初期化
-    if user_id not in chat_history_store:
-        chat_history_store[user_id] = []
-    if user_id not in turn_count_store:
-        turn_count_store[user_id] = 0
-    if user_id not in end_flag_store:
-        end_flag_store[user_id] = False
+    # 同じユーザーのリクエストが重なっても履歴の順序が崩れないよう、1 つずつ処理する
+    session = session_store.get(user_id)
+    async with session.lock:
+        try:
+            # handle_chat は同期版 ollama.chat を呼ぶので、イベントループを止めないようスレッドで実行する
+            # （他ユーザーのリクエストや /ready・/metrics は待たせない）
+            return await asyncio.to_thread(handle_chat, session, user_message)
+        finally:
+            # 履歴・カウンタ・終了フラグの変更を反映する
+            session_store.save(session)
+
+
+def collect_metrics():
+    yield from metrics.cache_samples("moderation", moderation_cache.stats())
+    yield from metrics.cache_samples("emotion", emotion_cache.stats())
+    yield from metrics.session_samples(session_store.stats())
+
+
+metrics.add_collector(collect_metrics)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    処理段階ごとの所要時間・トークン数・キャッシュ・セッション数を Prometheus 形式で返す
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 
+@app.get("/ready")
+async def ready():
+    """
+    全モデルの読み込みが終わっていれば 200、そうでなければ 503 を返す（ロードバランサ用）
+    """
+    return JSONResponse(
+        status_code=200 if model_warmer.is_ready() else 503,
+        content=model_warmer.status(),
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    # モデルを読み込んでからリクエストを受け付ける
+    await model_warmer.warm_up()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 書き出し待ちのセッション・スパンを保存してから終了する
+    session_store.close()
+    tracing.shutdown()
+
+
+def handle_chat(session: Session, user_message: str) -> ChatResponse:
+    """
+    1 ターン分の処理（セッションのロックを取った状態で呼ぶ）
+    """
     # 0) すでに終了してたら返答を作らない
-    if end_flag_store[user_id]:
+    if session.end_flag:
         reply_text = "この会話はすでに終了しています。最初からやり直す場合はリセットしてください。"
         emotion_score = 5
         return ChatResponse(
@@ -183,14 +342,15 @@ async def chat_endpoint(request: ChatRequest):
         )
 
     # 2) 履歴にユーザー入力を追加
-    chat_history_store[user_id].append({'role': 'user', 'content': user_message})
+    session.history.append({'role': 'user', 'content': user_message})
 
-    # コンテキストは「直近10往復分」だけ使う
-    recent_history = chat_history_store[user_id][-2 * CONTEXT_TURNS:]
+    # コンテキストはトークン予算に収まる直近の発言だけ使う
+    recent_history, context_tokens = context.assemble_context(session.history, CONTEXT_TOKEN_BUDGET)
+    print(f"Context: {len(recent_history)} messages, {context_tokens} tokens")
 
     # 3) 返答生成（最大10回）
-    if turn_count_store[user_id] >= MAX_TURNS:
-        end_flag_store[user_id] = True
+    if session.turn_count >= MAX_TURNS:
+        session.end_flag = True
         reply_text = "会話回数の上限に達したので終了します。"
         emotion_score = 5
         return ChatResponse(
@@ -201,18 +361,18 @@ async def chat_endpoint(request: ChatRequest):
         )
 
     reply_text = generate_ai_response(recent_history)
-    chat_history_store[user_id].append({'role': 'assistant', 'content': reply_text})
+    session.history.append({'role': 'assistant', 'content': reply_text})
 
-    turn_count_store[user_id] += 1
+    session.turn_count += 1
 
     # 4) 表情スコア算出（応答内容ベース）
     emotion_score = evaluate_emotion(reply_text)
 
     # 5) 状態判定 → 終了判定
     state_code = determine_state(user_message, reply_text)
-    end_flag = (state_code == 10) or (turn_count_store[user_id] >= MAX_TURNS)
+    end_flag = (state_code == 10) or (session.turn_count >= MAX_TURNS)
 
-    end_flag_store[user_id] = end_flag
+    session.end_flag = end_flag
 
     # 6) レスポンス返却
     return ChatResponse(
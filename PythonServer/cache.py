@@ -0,0 +1,83 @@
+# cache.py
+# LLM の判定結果（モデレーション・表情スコア）を使い回すためのプロセス内キャッシュ
+#  ※ 件数上限を超えたら最も使われていないものから捨て(LRU)、
+#    一定時間(TTL)を過ぎたものは期限切れとして扱う
+
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_TTL_SECONDS = 60 * 60
+
+
+def make_key(model: str, prompt_version: int, text: str) -> Tuple[str, int, str]:
+    """
+    モデル名・プロンプトのバージョン・正規化した入力テキストからキーを作る
+    （全角/半角と前後・連続する空白の違いは同じ入力とみなす）
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return (model, prompt_version, normalized)
+
+
+class TTLCache:
+    """
+    LRU 方式で件数を制限し、TTL で期限切れにするキャッシュ
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        キャッシュ済みの値を返す（無い・期限切れなら None）
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,85 @@
+# context.py
+# 返答生成に渡す会話履歴を、発言数ではなくトークン数の予算で組み立てる
+#  ※ 日本語の長い発言でコンテキスト長を溢れさせず、短い発言で枠を余らせないため
+#  ※ 各発言のトークン数はキャッシュするので、同じ発言を数え直すことはない
+
+import math
+import re
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_TOKEN_BUDGET = 2048
+
+# チャットテンプレートで 1 発言ごとに付く role ヘッダ等の分
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# かな・カタカナ・漢字・半角カナ（Llama 系のトークナイザでは概ね 1 文字 1 トークン前後）
+_CJK = re.compile(r"[぀-ヿ㐀-鿿豈-﫿ｦ-ﾟ]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークナイザを使わずにトークン数を見積もる
+    日本語は 1 文字 1 トークン、それ以外（英数字・記号・空白）は 4 文字 1 トークンとして数える
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TokenCounter:
+    """
+    発言ごとのトークン数をキャッシュしながら数える
+    tokenize には正確なトークナイザ（テキスト -> トークン数）を差し替えられる
+    """
+
+    def __init__(self, tokenize: Optional[Callable[[str], int]] = None, cache_size: int = 8192):
+        self._count = lru_cache(maxsize=cache_size)(tokenize or estimate_tokens)
+
+    def count_text(self, text: str) -> int:
+        return self._count(text)
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self._count(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+    def cache_info(self):
+        return self._count.cache_info()
+
+
+default_counter = TokenCounter()
+
+# 組み立てたコンテキストのトークン数の集計
+_stats: Dict[str, int] = {"requests": 0, "total_tokens": 0, "last_tokens": 0, "max_tokens": 0, "dropped_messages": 0}
+
+
+def assemble_context(messages: Sequence[Dict[str, str]], token_budget: int = DEFAULT_TOKEN_BUDGET,
+                     pinned: Sequence[Dict[str, str]] = (),
+                     counter: TokenCounter = default_counter) -> Tuple[List[Dict[str, str]], int]:
+    """
+    pinned（要約など）を必ず含め、残りの予算に収まるだけ messages を新しい方から詰める
+    最新の発言は予算を超えていても必ず含める
+    戻り値は (pinned + 選ばれた発言, 合計トークン数)
+    """
+    used = sum(counter.count_message(m) for m in pinned)
+    selected: List[Dict[str, str]] = []
+    for message in reversed(messages):
+        tokens = counter.count_message(message)
+        if selected and used + tokens > token_budget:
+            break
+        selected.append(message)
+        used += tokens
+    selected.reverse()
+
+    _stats["requests"] += 1
+    _stats["total_tokens"] += used
+    _stats["last_tokens"] = used
+    _stats["max_tokens"] = max(_stats["max_tokens"], used)
+    _stats["dropped_messages"] += len(messages) - len(selected)
+    return list(pinned) + selected, used
+
+
+def stats() -> Dict[str, float]:
+    """
+    リクエストごとに渡したコンテキストのトークン数の集計を返す
+    """
+    requests = _stats["requests"]
+    return {**_stats, "mean_tokens": _stats["total_tokens"] / requests if requests else 0.0}
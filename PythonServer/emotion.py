@@ -0,0 +1,113 @@
+# emotion.py
+# 日本語の感情語辞書 + 簡単なルールで表情用スコア(0-15)を推定するローカルスコアラー
+#  ※ LLM を呼ばないので 1 回あたりの処理はマイクロ秒オーダー
+#  ※ 判定に自信がない場合は confident=False を返し、呼び出し側で LLM にフォールバックできる
+
+import re
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# 感情語辞書（語 -> 極性 -1.0〜+1.0）
+#  語幹で登録しておくと活用形（楽しい/楽しかった 等）もまとめて拾える
+DEFAULT_LEXICON: Dict[str, float] = {
+    # ポジティブ
+    "ありがとう": 0.9, "感謝": 0.9, "嬉し": 1.0, "うれし": 1.0, "楽し": 1.0,
+    "たのし": 1.0, "素晴らし": 1.0, "すばらし": 1.0, "最高": 1.0, "おめでとう": 1.0,
+    "幸せ": 1.0, "しあわせ": 1.0, "素敵": 0.8, "すてき": 0.8, "良かった": 0.8,
+    "よかった": 0.8, "良い": 0.6, "よい": 0.5, "いいですね": 0.8, "好き": 0.8,
+    "大好き": 1.0, "面白": 0.8, "おもしろ": 0.8, "ワクワク": 0.9, "わくわく": 0.9,
+    "期待": 0.5, "安心": 0.6, "頑張": 0.6, "がんば": 0.6, "応援": 0.7,
+    "素直": 0.4, "成長": 0.5, "成功": 0.8, "達成": 0.7, "できます": 0.3,
+    "大丈夫": 0.4, "喜": 0.9, "笑": 0.6, "元気": 0.6, "興味深い": 0.6,
+    "なるほど": 0.3, "さすが": 0.8, "うまく": 0.4, "上手": 0.6, "ぜひ": 0.4,
+    # ネガティブ
+    "申し訳": -0.8, "申し訳ない": -0.8, "申し訳ありません": -0.8, "申し訳ございません": -0.8,
+    "すみません": -0.6, "すいません": -0.6, "ごめん": -0.7,
+    "残念": -0.8, "悲し": -1.0, "かなし": -1.0, "つら": -0.9, "辛い": -0.9,
+    "苦し": -0.9, "寂し": -0.8, "さみし": -0.8, "不安": -0.7, "心配": -0.5,
+    "困": -0.6, "難し": -0.4, "むずかし": -0.4, "エラー": -0.8, "失敗": -0.7,
+    "できません": -0.6, "怒": -0.8, "嫌": -0.8, "疲れ": -0.6,
+    "悪い": -0.6, "遅れ": -0.4, "問題": -0.3, "ミス": -0.5, "落ち込": -0.9,
+    "がっかり": -0.9, "痛": -0.6, "怖": -0.7, "こわ": -0.6, "最悪": -1.0,
+}
+
+# 直後に付くと極性を反転させる否定表現（例: 楽しくない, 良くありません）
+NEGATION_PATTERN = r"(?:く|では|じゃ)?(?:ない|なかった|ありません|ません)"
+NEGATION_FACTOR = 0.7   # 否定時は反転した上で少し弱める
+
+EXCLAMATION_BOOST = 0.15  # 「！」1 つあたりの強調倍率
+MAX_EXCLAMATION_BOOST = 0.6
+SATURATION = 1.5        # 極性合計をこの程度で飽和させる（tanh のスケール）
+
+# confident 判定のしきい値
+MIN_CONFIDENT_STRENGTH = 0.25  # |正規化スコア| がこれ未満なら自信なし
+MAX_MIXED_RATIO = 0.5          # 逆極性の割合がこれを超えると自信なし
+
+
+class LexiconEmotionScorer:
+    """
+    感情語辞書を 1 本の正規表現にまとめ、1 回の走査でヒット語を拾って
+    NumPy で極性を集計するスコアラー
+    """
+
+    def __init__(self, lexicon: Optional[Dict[str, float]] = None):
+        lexicon = DEFAULT_LEXICON if lexicon is None else lexicon
+        # 長い語を優先してマッチさせる（「大好き」を「好き」より先に）
+        terms = sorted(lexicon, key=len, reverse=True)
+        self._index = {term: i for i, term in enumerate(terms)}
+        self._weights = np.array([lexicon[t] for t in terms], dtype=np.float64)
+        self._pattern = re.compile(
+            "(" + "|".join(map(re.escape, terms)) + ")(" + NEGATION_PATTERN + ")?"
+        )
+
+    def score(self, text: str) -> Tuple[int, bool]:
+        """
+        テキストの表情用スコア(0-15)と、その判定に自信があるかを返す
+        """
+        hits = self._pattern.findall(text)
+        if not hits:
+            return 7, False
+
+        indices = np.fromiter((self._index[term] for term, _ in hits), dtype=np.intp, count=len(hits))
+        negated = np.fromiter((bool(neg) for _, neg in hits), dtype=bool, count=len(hits))
+        polarity = self._weights[indices] * np.where(negated, -NEGATION_FACTOR, 1.0)
+
+        positive = polarity[polarity > 0].sum()
+        negative = -polarity[polarity < 0].sum()
+        total = positive - negative
+
+        exclamations = text.count("！") + text.count("!")
+        total *= 1.0 + min(MAX_EXCLAMATION_BOOST, EXCLAMATION_BOOST * exclamations)
+
+        normalized = float(np.tanh(total / SATURATION))
+        score = int(np.clip(np.rint(7.5 + 7.5 * normalized), 0, 15))
+
+        mixed_ratio = min(positive, negative) / max(positive, negative)
+        confident = bool(abs(normalized) >= MIN_CONFIDENT_STRENGTH and mixed_ratio <= MAX_MIXED_RATIO)
+        return score, confident
+
+
+def load_lexicon(path: str) -> Dict[str, float]:
+    """
+    「語<TAB>極性」形式の TSV から感情語辞書を読み込む（# で始まる行は無視）
+    """
+    lexicon: Dict[str, float] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            term, polarity = line.split("\t")[:2]
+            lexicon[term] = max(-1.0, min(1.0, float(polarity)))
+    return lexicon
+
+
+_default_scorer = LexiconEmotionScorer()
+
+
+def score_emotion(text: str) -> Tuple[int, bool]:
+    """
+    既定の辞書でスコア(0-15)と自信の有無を返す
+    """
+    return _default_scorer.score(text)
@@ -1,13 +1,62 @@
 import ollama
+from concurrent.futures import ThreadPoolExecutor
+import score_cache
 import prompts  # 先ほど作成したprompts.pyをインポート
 
 # Ollamaで使用するモデル名
 # 実行前に `ollama pull hf.co/mmnga/Llama-3.1-Swallow-8B-Instruct-v0.5-gguf` 等でモデルを準備してください
 MODEL_NAME = "hf.co/mmnga/Llama-3.1-Swallow-8B-Instruct-v0.5-gguf"
 
+# 同時に Ollama へ投げる評価リクエスト数の上限（Ollama 側の OLLAMA_NUM_PARALLEL に合わせる）
+EVAL_CONCURRENCY = 3
+
+# 評価結果のディスクキャッシュ（同じモデル・プロンプト・会話データの再評価を省略する）
+SCORE_CACHE_PATH = "score_cache.sqlite3"
+evaluation_cache = score_cache.ScoreCache(SCORE_CACHE_PATH)
+
+def evaluate_criterion(criteria_name, prompt_template, before_response, userinput1, response1, log):
+    """
+    1つの観点について評価し、スコア文字列（失敗時は "Error"）を返す
+    """
+    # プロンプトに変数を埋め込む
+    formatted_prompt = prompt_template.format(
+        before_response=before_response,
+        userinput1=userinput1,
+        response1=response1,
+        log=log
+    )
+
+    cache_key = score_cache.make_key(MODEL_NAME, prompt_template, before_response, userinput1, response1, log)
+    cached = evaluation_cache.get(cache_key)
+    if cached is not None:
+        print(f"{criteria_name}: {cached} (cached)")
+        return cached
+
+    try:
+        # Ollamaに問い合わせ
+        response = ollama.generate(
+            model=MODEL_NAME,
+            prompt=formatted_prompt,
+            options={
+                "temperature": 0.0, # 評価の一貫性のためランダム性を排除
+            }
+        )
+
+        # 応答からスコアを取得（余分な空白などを除去）
+        score = response['response'].strip()
+        print(f"{criteria_name}: {score}")
+
+    except Exception as e:
+        print(f"Error evaluating {criteria_name}: {e}")
+        return "Error"
+
+    evaluation_cache.put(cache_key, MODEL_NAME, prompt_template, score)
+    return score
+
 def evaluate_communication(before_response, userinput1, response1, log):
     """
     3つの観点でコミュニケーションを評価する関数
+    （各観点は EVAL_CONCURRENCY の範囲で並行して評価する）
     """
     
     # 評価項目の定義（名前とプロンプトテンプレートのペア）
@@ -16,38 +65,19 @@ def evaluate_communication(before_response, userinput1, response1, log):
         "2. 論理性・わかりやすさ": prompts.prompt_clarity,
         "3. 態度・協調性": prompts.prompt_attitude
     }
-    
-    results = {}
 
     print(f"--- 評価開始 (Model: {MODEL_NAME}) ---")
 
-    for criteria_name, prompt_template in evaluation_criteria.items():
-        # プロンプトに変数を埋め込む
-        formatted_prompt = prompt_template.format(
-            before_response=before_response,
-            userinput1=userinput1,
-            response1=response1,
-            log=log
-        )
-
-        try:
-            # Ollamaに問い合わせ
-            response = ollama.generate(
-                model=MODEL_NAME,
-                prompt=formatted_prompt,
-                options={
-                    "temperature": 0.0, # 評価の一貫性のためランダム性を排除
-                }
+    with ThreadPoolExecutor(max_workers=EVAL_CONCURRENCY) as executor:
+        futures = {
+            criteria_name: executor.submit(
+                evaluate_criterion, criteria_name, prompt_template,
+                before_response, userinput1, response1, log
             )
-            
-            # 応答からスコアを取得（余分な空白などを除去）
-            score = response['response'].strip()
-            results[criteria_name] = score
-            print(f"{criteria_name}: {score}")
-
-        except Exception as e:
-            print(f"Error evaluating {criteria_name}: {e}")
-            results[criteria_name] = "Error"
+            for criteria_name, prompt_template in evaluation_criteria.items()
+        }
+        # 結果は評価項目の定義順に並べる
+        results = {criteria_name: future.result() for criteria_name, future in futures.items()}
 
     print("--- 評価終了 ---")
     return results
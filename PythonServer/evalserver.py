@@ -1,86 +1,143 @@
-import re
+import json
+import asyncio
+from typing import Any, List
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import ollama
-import prompts  # prompts.py をインポート
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+import llm_client
+import metrics
+import score_cache
+import tracing
+import warmup
+from evaluator import EvaluationRequest, EvaluationResponse, Evaluator
 
 app = FastAPI(title="Communication Evaluator API")
 
+# リクエストごとのトレース（LLM 呼び出し・キャッシュ操作・フォールバックをスパンとして JSONL に書き出す）
+TRACE_PATH = "traces_evalserver.jsonl"  # None なら書き出さない
+tracing.configure("evalserver", TRACE_PATH)
+app.add_middleware(tracing.TracingMiddleware)
+
 # 使用するモデル名
 MODEL_NAME = "hf.co/mmnga/Llama-3.1-Swallow-8B-Instruct-v0.3-gguf:latest"
 
-# リクエストボディの定義
-class EvaluationRequest(BaseModel):
-    before_response: str
-    userinput1: str
-    response1: str
-    log: str
+# 起動時に読み込んでおくモデル（/ready で準備状況を返す）
+model_warmer = warmup.ModelWarmer([MODEL_NAME])
+
+# 同時に Ollama へ投げる評価リクエスト数の上限
+# （Ollama 側の OLLAMA_NUM_PARALLEL に合わせて調整する）
+EVAL_CONCURRENCY = 3
+
+# /evaluate_batch で同時に評価する会話データ数（ワーカー数）
+BATCH_WORKERS = 4
 
-# レスポンスボディの定義
-class EvaluationResponse(BaseModel):
-    relevance: int  # 的確性
-    clarity: int    # 論理性
-    attitude: int   # 態度
+# 評価結果のディスクキャッシュ（同じモデル・プロンプト・会話データの再評価を省略する）
+SCORE_CACHE_PATH = "score_cache.sqlite3"
+SCORE_CACHE_MAX_ENTRIES = 200_000
+evaluation_cache = score_cache.ScoreCache(SCORE_CACHE_PATH, max_entries=SCORE_CACHE_MAX_ENTRIES)
 
-def extract_score(text: str) -> int:
+# True にすると 3 観点を 1 回の問い合わせでまとめて評価する
+# （出力が不正な場合は観点ごとの評価にフォールバック）
+FUSED_EVALUATION = False
+
+# 評価処理本体（evaluator.py。server1 のバックグラウンド評価と共通）
+evaluator = Evaluator(MODEL_NAME, evaluation_cache, EVAL_CONCURRENCY, fused=FUSED_EVALUATION)
+evaluate_request = evaluator.evaluate
+
+@app.post("/evaluate", response_model=EvaluationResponse)
+async def evaluate(request: EvaluationRequest):
     """
-    LLMの応答テキストから数字(1-5)を抽出するヘルパー関数
-    想定外の文字が含まれていた場合の対策
+    会話データをPOSTで受け取り、3観点の評価スコアを返す
+    （従来どおり、評価に失敗した観点は 0 点として返す）
     """
-    match = re.search(r'[1-5]', text)
-    if match:
-        return int(match.group(0))
-    else:
-        # 数字が見つからない場合はエラー値として0またはデフォルト値(3など)を返す
-        # ここではエラー扱いとして0とします
-        return 0
-
-def query_ollama(prompt_template: str, data: EvaluationRequest) -> int:
+    return await evaluate_request(request)
+
+@app.post("/evaluate_batch")
+async def evaluate_batch(items: List[Any]):
     """
-    Ollamaに問い合わせてスコア(int)を返す
+    会話データ(EvaluationRequest)のリストを受け取り、BATCH_WORKERS 個のワーカーで評価する
+    結果は終わった順に NDJSON で 1 行ずつ返す
+      成功: {"index": 入力順の番号, "result": {"relevance": .., "clarity": .., "attitude": ..}}
+      失敗: {"index": 入力順の番号, "error": "..."}（他の項目の評価は続行する）
+    ※ /evaluate と違い、Ollama のエラー等でスコアを得られなかった項目は 0 点にせず失敗として返す
     """
-    formatted_prompt = prompt_template.format(
-        before_response=data.before_response,
-        userinput1=data.userinput1,
-        response1=data.response1,
-        log=data.log
-    )
-    
-    try:
-        response = ollama.generate(
-            model=MODEL_NAME,
-            prompt=formatted_prompt,
-            options={"temperature": 0.0} # 評価の安定性のためランダム性を排除
-        )
-        raw_content = response['response'].strip()
-        return extract_score(raw_content)
-        
-    except Exception as e:
-        print(f"Ollama Error: {e}")
-        # エラー時は0を返す、または例外をraiseする設計にする
-        return 0
+    async def result_stream():
+        pending: asyncio.Queue = asyncio.Queue()
+        for index, item in enumerate(items):
+            pending.put_nowait((index, item))
+        finished: asyncio.Queue = asyncio.Queue()
 
-@app.post("/evaluate", response_model=EvaluationResponse)
-def evaluate(request: EvaluationRequest):
+        async def worker():
+            while not pending.empty():
+                index, item = pending.get_nowait()
+                try:
+                    result = await evaluate_request(EvaluationRequest.model_validate(item), strict=True)
+                    line = {"index": index, "result": result.model_dump()}
+                except ValidationError as e:
+                    line = {
+                        "index": index,
+                        "error": "invalid request",
+                        "detail": e.errors(include_url=False, include_input=False),
+                    }
+                except Exception as e:
+                    print(f"Batch item {index} Error: {e}")
+                    line = {"index": index, "error": str(e)}
+                await finished.put(line)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(BATCH_WORKERS, len(items)))]
+        try:
+            for _ in range(len(items)):
+                line = await finished.get()
+                yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+        finally:
+            # クライアント切断時は残りの評価を打ち切る
+            for task in workers:
+                task.cancel()
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+@app.get("/stats")
+async def stats():
     """
-    会話データをPOSTで受け取り、3観点の評価スコアを返す
+    評価キャッシュの統計情報を返す
+    """
+    return {
+        "score_cache": await asyncio.to_thread(evaluation_cache.stats),
+        "scheduler": llm_client.scheduler.stats(),
+        "llm": llm_client.stats(),
+    }
+
+metrics.add_collector(lambda: metrics.cache_samples("score", evaluation_cache.stats()))
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    評価処理の所要時間・トークン数・キュー長・キャッシュを Prometheus 形式で返す
     """
-    
-    # 1. 回答の的確性
-    score_relevance = query_ollama(prompts.prompt_relevance, request)
-    
-    # 2. 論理性・わかりやすさ
-    score_clarity = query_ollama(prompts.prompt_clarity, request)
-    
-    # 3. 態度・協調性
-    score_attitude = query_ollama(prompts.prompt_attitude, request)
-
-    return EvaluationResponse(
-        relevance=score_relevance,
-        clarity=score_clarity,
-        attitude=score_attitude
+    # 評価キャッシュの件数集計は SQLite を読むのでスレッドで行う
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/ready")
+async def ready():
+    """
+    モデルの読み込みが終わっていれば 200、そうでなければ 503 を返す（ロードバランサ用）
+    """
+    return JSONResponse(
+        status_code=200 if model_warmer.is_ready() else 503,
+        content=model_warmer.status(),
     )
 
+@app.on_event("startup")
+async def startup():
+    # モデルを読み込んでからリクエストを受け付ける
+    await model_warmer.warm_up()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Ollama ホストの定期チェックを止め、書き出し待ちのスパンを保存してから終了する
+    await llm_client.close()
+    tracing.shutdown()
+
 if __name__ == "__main__":
     import uvicorn
     # 開発用サーバー起動設定
@@ -0,0 +1,224 @@
+# evaluator.py
+# 会話 1 ターンを 3 観点（的確性・論理性・ユーモア）で評価する処理
+#  ※ evalserver（/evaluate・/evaluate_batch）と server1（ターンごとのバックグラウンド評価）で共有する
+#  ※ 評価結果は score_cache に保存し、同じモデル・プロンプト・会話データの再評価を省略する
+#  ※ strict=True で評価すると、Ollama のエラーやスコアを読み取れない出力を 0 点にせず例外にする
+#    （/evaluate_batch・バックグラウンド評価で、失敗を本物の 0 点と区別して返すため）
+
+import asyncio
+import json
+import re
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+import llm_client
+import metrics
+import prompts  # prompts.py をインポート
+import score_cache
+import tracing
+
+# 3観点まとめて評価する際の出力 JSON スキーマ
+FUSED_CRITERIA = ("relevance", "clarity", "attitude")
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        name: {"type": "integer", "minimum": 1, "maximum": 5} for name in FUSED_CRITERIA
+    },
+    "required": list(FUSED_CRITERIA),
+}
+
+# 評価結果から読み取るスコア(1-5)
+SCORE_PATTERN = re.compile(r'[1-5]')
+
+class EvaluationError(Exception):
+    """
+    strict モードの評価で、スコアを得られなかった
+    """
+
+# リクエストボディの定義
+class EvaluationRequest(BaseModel):
+    before_response: str
+    userinput1: str
+    response1: str
+    log: str
+
+# レスポンスボディの定義
+class EvaluationResponse(BaseModel):
+    relevance: int  # 的確性
+    clarity: int    # 論理性
+    attitude: int   # 態度
+
+def extract_score(text: str) -> int:
+    """
+    LLMの応答テキストから数字(1-5)を抽出するヘルパー関数
+    想定外の文字が含まれていた場合の対策
+    """
+    match = SCORE_PATTERN.search(text)
+    if match:
+        return int(match.group(0))
+    else:
+        # 数字が見つからない場合はエラー値として0またはデフォルト値(3など)を返す
+        # ここではエラー扱いとして0とします
+        tracing.record_fallback(f"no score in {text!r}", 0)
+        return 0
+
+def parse_fused_scores(text: str) -> Optional[Dict[str, int]]:
+    """
+    3観点まとめての評価結果(JSON)を検証して取り出す（不正なら None）
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    scores = {}
+    for name in FUSED_CRITERIA:
+        value = data.get(name)
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= 5:
+            return None
+        scores[name] = value
+    return scores
+
+class Evaluator:
+    """
+    使用モデル・評価キャッシュ・同時実行数を持ち、会話データを 3 観点で評価する
+    fused=True にすると 3 観点を 1 回の問い合わせでまとめて評価する
+    （出力が不正な場合は観点ごとの評価にフォールバック）
+    """
+
+    def __init__(self, model: str, cache: Optional[score_cache.ScoreCache], concurrency: int,
+                 fused: bool = False):
+        self.model = model
+        self.cache = cache
+        self.fused = fused
+        # 同時に Ollama へ投げる評価リクエスト数の上限
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def make_cache_key(self, prompt_template: str, data: EvaluationRequest) -> str:
+        return score_cache.make_key(
+            self.model, prompt_template,
+            data.before_response, data.userinput1, data.response1, data.log
+        )
+
+    async def _cached(self, cache_key: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return await asyncio.to_thread(self.cache.get, cache_key)
+
+    async def _store(self, cache_key: str, prompt_template: str, response: str) -> None:
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, self.model, prompt_template, response)
+
+    @metrics.staged("evaluation")
+    async def query_ollama(self, prompt_template: str, data: EvaluationRequest, strict: bool = False) -> int:
+        """
+        Ollamaに問い合わせてスコア(int)を返す
+        （strict=True なら失敗時に 0 を返さず EvaluationError を投げる）
+        """
+        formatted_prompt = prompt_template.format(
+            before_response=data.before_response,
+            userinput1=data.userinput1,
+            response1=data.response1,
+            log=data.log
+        )
+
+        cache_key = self.make_cache_key(prompt_template, data)
+        cached = await self._cached(cache_key)
+        if cached is not None:
+            return self._score(cached, strict)
+
+        try:
+            async with self.semaphore:
+                response = await llm_client.generate(
+                    model=self.model,
+                    prompt=formatted_prompt,
+                    options={"temperature": 0.0}, # 評価の安定性のためランダム性を排除
+                    coalesce=True,
+                )
+            raw_content = response['response'].strip()
+
+        except Exception as e:
+            print(f"Ollama Error: {e}")
+            if strict:
+                raise EvaluationError(f"Ollama error: {e}") from e
+            # エラー時は0を返す、または例外をraiseする設計にする
+            tracing.record_fallback(e, 0)
+            return 0
+
+        await self._store(cache_key, prompt_template, raw_content)
+        return self._score(raw_content, strict)
+
+    @staticmethod
+    def _score(text: str, strict: bool) -> int:
+        if strict and SCORE_PATTERN.search(text) is None:
+            raise EvaluationError(f"no score in {text!r}")
+        return extract_score(text)
+
+    @metrics.staged("evaluation_fused")
+    async def query_ollama_fused(self, data: EvaluationRequest) -> Optional[EvaluationResponse]:
+        """
+        3観点を 1 回の問い合わせで評価する（失敗時は None）
+        """
+        formatted_prompt = prompts.prompt_fused.format(
+            before_response=data.before_response,
+            userinput1=data.userinput1,
+            response1=data.response1,
+            log=data.log
+        )
+
+        cache_key = self.make_cache_key(prompts.prompt_fused, data)
+        cached = await self._cached(cache_key)
+        if cached is not None:
+            scores = parse_fused_scores(cached)
+            if scores is not None:
+                return EvaluationResponse(**scores)
+
+        try:
+            async with self.semaphore:
+                response = await llm_client.generate(
+                    model=self.model,
+                    prompt=formatted_prompt,
+                    format=FUSED_SCHEMA, # 構造化出力で JSON に制約する
+                    options={"temperature": 0.0},
+                    coalesce=True,
+                )
+        except Exception as e:
+            print(f"Ollama Error (fused): {e}")
+            tracing.record_fallback(e, None)
+            return None
+
+        scores = parse_fused_scores(response['response'])
+        if scores is None:
+            print(f"Fused output parse error: {response['response']!r}")
+            tracing.record_fallback(f"invalid output {response['response']!r}", None)
+            return None
+        await self._store(cache_key, prompts.prompt_fused, response['response'])
+        return EvaluationResponse(**scores)
+
+    @metrics.staged("evaluate_request")
+    async def evaluate(self, request: EvaluationRequest, strict: bool = False) -> EvaluationResponse:
+        """
+        1件の会話データを3観点で評価する
+        （3観点は同時実行数の範囲で並行して評価する）
+        strict=True なら、どれか 1 観点でもスコアを得られなければ EvaluationError を投げる
+        """
+        if self.fused:
+            fused_result = await self.query_ollama_fused(request)
+            if fused_result is not None:
+                return fused_result
+            # まとめての評価に失敗したら観点ごとに評価し直す
+
+        score_relevance, score_clarity, score_attitude = await asyncio.gather(
+            self.query_ollama(prompts.prompt_relevance, request, strict), # 1. 回答の的確性
+            self.query_ollama(prompts.prompt_clarity, request, strict),   # 2. 論理性・わかりやすさ
+            self.query_ollama(prompts.prompt_attitude, request, strict),  # 3. ユーモア・ウィット
+        )
+
+        return EvaluationResponse(
+            relevance=score_relevance,
+            clarity=score_clarity,
+            attitude=score_attitude
+        )
@@ -0,0 +1,134 @@
+# journal.py
+# 完了した会話ターンを JSONL に書き出すトランスクリプトジャーナル（オフライン評価の入力用）
+#  ※ 1 行 1 ターンで、evaluator.EvaluationRequest（evalserver の入力）と同じ項目
+#    (before_response, userinput1, response1, log) だけを書くので、そのまま /evaluate_batch に渡せる
+#  ※ append() はメモリ上のバッファに積むだけで、ディスクへの書き込みは書き出しタスクがまとめて行う
+#    （ファイル操作はスレッドで行うので、リクエスト処理もイベントループも止めない）
+#  ※ ファイルは日付ごとに分け、サイズが上限を超えたら連番の新しいファイルに切り替える
+#    例: transcripts/transcripts-20250101-001.jsonl, transcripts-20250101-002.jsonl, ...
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+TRANSCRIPT_FIELDS = ("before_response", "userinput1", "response1", "log")
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_PENDING = 10_000  # 書き出し待ちの上限（ディスクが詰まった時にメモリを使い切らないため）
+
+
+class TranscriptJournal:
+    """
+    完了したターンをバッファに積み、flush_interval ごとにまとめて追記する
+    """
+
+    def __init__(self, directory: str, prefix: str = "transcripts", max_bytes: int = DEFAULT_MAX_BYTES,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS, max_pending: int = DEFAULT_MAX_PENDING):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        os.makedirs(directory, exist_ok=True)
+        self._buffer: Deque[Dict[str, str]] = deque()
+        self._write_lock = threading.Lock()
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+        self._date = ""
+        self._index = 0
+        self._written = 0
+        self._dropped = 0
+        self._errors = 0
+
+    def append(self, record: Dict[str, Any]) -> None:
+        """
+        1 ターン分を書き出し待ちに積む（ブロックしない。上限を超えたら捨てて数える）
+        """
+        if len(self._buffer) >= self.max_pending:
+            self._dropped += 1
+            return
+        self._buffer.append({field: record[field] for field in TRANSCRIPT_FIELDS})
+        self._ensure_writer()
+
+    def _ensure_writer(self) -> None:
+        # 最初の append 時に、そのイベントループ上で書き出しタスクを開始する
+        task = self._writer
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._writer = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        書き出し待ちをすべてファイルに追記する
+        """
+        batch = []
+        while self._buffer:
+            batch.append(self._buffer.popleft())
+        if batch:
+            await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch: List[Dict[str, str]]) -> None:
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        with self._write_lock:
+            try:
+                path = self._current_path(len(lines.encode("utf-8")))
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                self._written += len(batch)
+            except OSError as e:
+                print(f"Journal Write Error: {e}")
+                self._errors += len(batch)
+
+    def _current_path(self, incoming: int) -> str:
+        """
+        書き込み先のファイル（日付が変わるかサイズ上限を超えるなら次のファイル）
+        """
+        date = time.strftime("%Y%m%d")
+        if date != self._date:
+            self._date = date
+            self._index = self._last_index(date) or 1
+        path = self._path(date, self._index)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size and size + incoming > self.max_bytes:
+            self._index += 1
+            path = self._path(date, self._index)
+        return path
+
+    def _path(self, date: str, index: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{date}-{index:03d}.jsonl")
+
+    def _last_index(self, date: str) -> int:
+        # 再起動後は同じ日付の最後のファイルに続けて書く
+        pattern = re.compile(rf"{re.escape(self.prefix)}-{date}-(\d+)\.jsonl$")
+        indexes = [int(m.group(1)) for name in os.listdir(self.directory) if (m := pattern.match(name))]
+        return max(indexes, default=0)
+
+    async def close(self) -> None:
+        """
+        書き出しタスクを止め、残りをすべて書き出す
+        """
+        self._closing = True
+        task = self._writer
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            await task
+        await self.flush()
+        self._closing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._buffer),
+            "written": self._written,
+            "dropped": self._dropped,
+            "errors": self._errors,
+            "file": self._path(self._date, self._index) if self._date else None,
+        }
@@ -0,0 +1,232 @@
+# llm_client.py
+# サーバ間で共有する非同期 Ollama クライアント
+#  ※ 同期版 ollama.chat はイベントループを止めてしまうため、
+#    FastAPI の async エンドポイントからはこちらを使う
+#  ※ すべての呼び出しは scheduler を通し、ユーザー間で公平に・同時実行数を抑えて Ollama に投げる
+#  ※ coalesce=True を付けた呼び出しは、同じ引数の呼び出しが同時に来た場合に 1 回だけ Ollama に投げ、
+#    結果を全員で共有する(singleflight)
+#    （授業開始時に全員が同じ挨拶を送ったときの入力チェック・定型文の感情スコアなど）
+#    結果が毎回同じになる呼び出し（入力チェック・感情スコア・temperature 0 の評価）にだけ付ける。
+#    サンプリングする返答生成に付けると、履歴が同じ別ユーザーに同じ返答を返してしまう
+#  ※ 共有は同じ優先度の呼び出しどうしに限る（会話の呼び出しが低優先度の呼び出しの完了を待たないように）
+#  ※ OLLAMA_HOSTS に複数のホストを並べると router が負荷の少ないホストに振り分ける
+#  ※ 呼び出しごとに ollama.chat / ollama.generate のスパンを作り、モデル・トークン数・結果を記録する
+
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+import metrics
+import tracing
+from router import OllamaRouter
+from scheduler import FairScheduler, current_user, low_priority
+
+# 使用する Ollama ホストの一覧
+# None の場合は環境変数 OLLAMA_HOST（未設定なら localhost:11434）を使う
+# 例: ["http://gpu1:11434", "http://gpu2:11434"]
+OLLAMA_HOSTS = [None]
+
+# 応答しないホストを振り分け対象から外す時間・状態確認の間隔（秒）
+HOST_EJECT_SECONDS = 30
+HEALTH_CHECK_INTERVAL = 10
+
+# 接続プール設定（1 ホストあたりに同時に張る HTTP 接続の上限）
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+
+# モデルを読み込んだままにしておく時間（呼び出しのたびに延長される）
+KEEP_ALIVE = "30m"
+
+# スケジューラ設定
+MAX_IN_FLIGHT_PER_HOST = 4  # 1 ホストあたり同時に投げる呼び出し数
+MAX_QUEUE = 64              # 呼び出しの待ち行列の上限（超えたら新規リクエストは 503）
+MAX_PENDING_PER_USER = 4    # 1 ユーザーの処理中リクエスト数の上限（超えたら 429）
+MAX_BACKGROUND_IN_FLIGHT = 1  # 低優先度の呼び出し（バックグラウンド評価など）に使ってよい枠の数
+
+# プロセス全体で 1 つだけ作り、HTTP 接続を使い回す
+router = OllamaRouter(
+    OLLAMA_HOSTS,
+    limits=httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    eject_seconds=HOST_EJECT_SECONDS,
+    health_check_interval=HEALTH_CHECK_INTERVAL,
+)
+
+scheduler = FairScheduler(
+    max_in_flight=MAX_IN_FLIGHT_PER_HOST * len(OLLAMA_HOSTS),
+    max_queue=MAX_QUEUE,
+    max_pending_per_user=MAX_PENDING_PER_USER,
+    max_background_in_flight=MAX_BACKGROUND_IN_FLIGHT,
+)
+metrics.add_collector(lambda: metrics.scheduler_samples(scheduler.stats()))
+
+
+def record_response(span: tracing.Span, response: Any) -> None:
+    """
+    Ollama の応答（またはストリームの最後のチャンク）のトークン数・終了理由をスパンに記録する
+    """
+    span.set_attribute("llm.prompt_eval_count", response.get('prompt_eval_count'))
+    span.set_attribute("llm.eval_count", response.get('eval_count'))
+    span.set_attribute("llm.done_reason", response.get('done_reason'))
+
+
+def start_call_span(method: str, kwargs) -> tracing.Span:
+    """
+    Ollama 呼び出し 1 回分のスパンを作る（role は現在の処理段階）
+    """
+    return tracing.start_span(
+        f"ollama.{method}", kind=tracing.KIND_CLIENT,
+        **{"llm.model": kwargs.get('model'), "llm.role": metrics.current_stage.get(),
+           "llm.stream": bool(kwargs.get('stream')), "llm.background": low_priority.get()},
+    )
+
+
+async def _stream_in_slot(method: str, kwargs):
+    """
+    ストリームを最後まで読み終わる（または途中で閉じられる）まで実行枠を保持する
+    """
+    # ジェネレータは呼び出し元のコンテキストで動くため、スパンはチャンクを待つ間だけ現在のスパンにする
+    span = start_call_span(method, kwargs)
+    try:
+        queued = time.perf_counter()
+        async with scheduler.slot(current_user.get(), background=low_priority.get()):
+            span.set_attribute("scheduler.wait_seconds", round(time.perf_counter() - queued, 6))
+            chunks = router.stream(method, kwargs)
+            while True:
+                with tracing.use_span(span):
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                if chunk.get('done'):
+                    metrics.record_ollama(chunk)
+                    record_response(span, chunk)
+                yield chunk
+    except GeneratorExit:
+        # 呼び出し元が途中で読むのをやめた（エラーではない）
+        span.add_event("closed")
+        raise
+    except BaseException as e:
+        tracing.record_exception(span, e)
+        raise
+    finally:
+        tracing.end_span(span)
+
+
+async def _call_in_slot(method: str, kwargs):
+    queued = time.perf_counter()
+    async with scheduler.slot(current_user.get(), background=low_priority.get()):
+        tracing.set_attribute("scheduler.wait_seconds", round(time.perf_counter() - queued, 6))
+        response = await router.request(method, kwargs)
+    metrics.record_ollama(response)
+    return response
+
+
+class _Flight:
+    """
+    実行中の 1 回分の呼び出しと、その結果を待っている呼び出し元の数
+    """
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+# 呼び出し内容 -> 実行中の呼び出し
+_in_flight: Dict[str, _Flight] = {}
+_stats: Dict[str, int] = {"calls": 0, "coalesced": 0}
+
+
+def _forget(key: str, flight: _Flight) -> None:
+    if _in_flight.get(key) is flight:
+        del _in_flight[key]
+
+
+def _flight_key(method: str, kwargs) -> str:
+    return json.dumps([method, low_priority.get(), kwargs], ensure_ascii=False, sort_keys=True, default=str)
+
+
+async def _call(method: str, kwargs, coalesce: bool):
+    kwargs.setdefault('keep_alive', KEEP_ALIVE)
+    if kwargs.get('stream'):
+        return _stream_in_slot(method, kwargs)
+
+    _stats["calls"] += 1
+    span = start_call_span(method, kwargs)
+    try:
+        with tracing.use_span(span):
+            if coalesce:
+                response = await _join_flight(_flight_key(method, kwargs), method, kwargs, span)
+            else:
+                response = await _call_in_slot(method, kwargs)
+        record_response(span, response)
+        return response
+    except BaseException as e:
+        tracing.record_exception(span, e)
+        raise
+    finally:
+        tracing.end_span(span)
+
+
+async def _join_flight(key: str, method: str, kwargs, span: tracing.Span):
+    flight = _in_flight.get(key)
+    if flight is None:
+        # タスクは現在のコンテキスト（このスパン）を引き継ぐので、ホスト・待ち時間はこのスパンに記録される
+        flight = _Flight(asyncio.ensure_future(_call_in_slot(method, kwargs)))
+        _in_flight[key] = flight
+        flight.task.add_done_callback(lambda _: _forget(key, flight))
+        span.set_attribute("llm.coalesced", False)
+    else:
+        _stats["coalesced"] += 1
+        span.set_attribute("llm.coalesced", True)
+
+    flight.waiters += 1
+    try:
+        # 1 人が取り消されても、他に待っている人がいれば呼び出しは続ける
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # 誰も待っていない呼び出しは取り消す（以降の同じ呼び出しは新しく投げ直す）
+            _forget(key, flight)
+            flight.task.cancel()
+
+
+async def chat(coalesce: bool = False, **kwargs):
+    """
+    ollama.chat の非同期版（引数は ollama.chat と同じ）
+    coalesce=True なら同時に来た同じ呼び出しと結果を共有する（結果が毎回同じになる呼び出しだけに使う）
+    """
+    return await _call('chat', kwargs, coalesce)
+
+
+async def generate(coalesce: bool = False, **kwargs):
+    """
+    ollama.generate の非同期版（引数は ollama.generate と同じ）
+    coalesce=True なら同時に来た同じ呼び出しと結果を共有する（結果が毎回同じになる呼び出しだけに使う）
+    """
+    return await _call('generate', kwargs, coalesce)
+
+
+async def load_model(model: str, keep_alive: str = KEEP_ALIVE) -> Dict[str, Optional[Exception]]:
+    """
+    すべてのホストにモデルを読み込ませる（空のプロンプトの generate は読み込みだけを行う）
+    戻り値はホスト -> 例外（成功なら None）
+    """
+    return await router.broadcast('generate', {'model': model, 'prompt': "", 'keep_alive': keep_alive})
+
+
+async def close() -> None:
+    """
+    ホストの定期チェックを止める（サーバ終了時に呼ぶ）
+    """
+    await router.close()
+
+
+def stats() -> Dict[str, Any]:
+    return {**_stats, "in_flight": len(_in_flight), "router": router.stats()}
@@ -0,0 +1,246 @@
+# loadtest.py
+# server1 に対して、Unity と同じ形のリクエストで複数ターンの会話を再生する負荷試験ツール
+#  1 セッション = /reset の後にスクリプトの発言を順に /send_message へ送る（end=true が返れば打ち切り）
+#
+# 使い方:
+#   python loadtest.py --concurrency 20 --sessions 200             # 同時 20 ユーザーで 200 セッション
+#   python loadtest.py --rate 2 --sessions 100                     # 平均 2 セッション/秒で到着させる
+#   python loadtest.py --scripts scripts.jsonl --output run1.json   # 会話スクリプトと結果の保存先を指定
+#
+# スクリプトの JSONL は 1 行 1 セッションで {"messages": ["こんにちは", ...]} の形式です。
+# 結果は JSON で保存されるので、設定変更の前後で比較できます。
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import httpx
+from pydantic import BaseModel
+
+DEFAULT_URL = "http://localhost:5000"
+REQUEST_TIMEOUT_SECONDS = 300
+
+# server1 の Request/Response モデルと同じ形
+#  ※ server1 を import するとサーバ側の初期化（ルータ・セッションストア・ジャーナル等）まで走るので、
+#    負荷をかける側では必要な項目だけをここに定義する
+class RequestSendPlayerMessage(BaseModel):
+    message: str = ""
+    user_id: str = "default"
+
+
+class ResponseSendPlayerMessage(BaseModel):
+    message: str
+    face_type: int
+    score: int
+    end: bool
+
+
+class RequestReset(BaseModel):
+    user_id: str = "default"
+
+
+# 組み込みの会話スクリプト（--scripts 未指定時）
+DEFAULT_SCRIPTS = [
+    ["こんにちは！", "最近プログラミングの勉強を始めました。", "どうやったら続けられますか？", "ありがとうございます、さようなら"],
+    ["はじめまして", "趣味は読書です。", "おすすめの本はありますか？", "なるほど、読んでみます。", "終了します"],
+    ["こんにちは", "明日のプレゼンが不安です。", "緊張しないコツを教えてください。", "練習してみます！"],
+    ["やあ", "今日は天気がいいですね。", "週末は何をしたらいいと思いますか？", "いいですね", "それではまた"],
+]
+
+
+def load_scripts(path: str) -> List[List[str]]:
+    scripts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                scripts.append(json.loads(line)["messages"])
+    return scripts
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """
+    最近接順位法によるパーセンタイル（sorted_values は昇順）
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """
+    リクエストごとの結果（エンドポイント・所要時間・ステータス・end）を集める
+    """
+
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+
+    def add(self, endpoint: str, latency: float, status: Optional[int],
+            error: Optional[str] = None) -> Dict[str, Any]:
+        record = {"endpoint": endpoint, "latency": latency, "status": status, "error": error, "end": None}
+        self.records.append(record)
+        return record
+
+    def summarize(self, records: List[Dict[str, Any]], wall_seconds: float) -> Dict[str, Any]:
+        ok = [r for r in records if r["error"] is None]
+        latencies = sorted(r["latency"] for r in ok)
+        statuses: Dict[str, int] = {}
+        for r in records:
+            key = str(r["status"]) if r["status"] is not None else "connection_error"
+            statuses[key] = statuses.get(key, 0) + 1
+        ends = [r["end"] for r in ok if r["end"] is not None]
+        summary = {
+            "requests": len(records),
+            "errors": len(records) - len(ok),
+            "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+            "throughput_rps": len(ok) / wall_seconds if wall_seconds else 0.0,
+            "latency_seconds": {
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "status_codes": statuses,
+        }
+        if ends:
+            summary["end_true_share"] = sum(ends) / len(ends)
+        return summary
+
+    def report(self, wall_seconds: float) -> Dict[str, Any]:
+        return {
+            "overall": self.summarize(self.records, wall_seconds),
+            "reset": self.summarize([r for r in self.records if r["endpoint"] == "reset"], wall_seconds),
+            "send_message": self.summarize([r for r in self.records if r["endpoint"] == "send_message"], wall_seconds),
+        }
+
+
+async def timed_post(client: httpx.AsyncClient, recorder: Recorder, endpoint: str, body: Dict[str, Any]):
+    """
+    POST して所要時間を記録する（成功時は (レスポンス, 記録)、失敗時は None を返す）
+    """
+    started = time.perf_counter()
+    try:
+        response = await client.post(f"/{endpoint}", json=body)
+    except httpx.HTTPError as e:
+        recorder.add(endpoint, time.perf_counter() - started, None, error=repr(e))
+        return None
+    latency = time.perf_counter() - started
+    if response.status_code != 200:
+        recorder.add(endpoint, latency, response.status_code, error=response.text[:200])
+        return None
+    return response, recorder.add(endpoint, latency, response.status_code)
+
+
+async def run_session(client: httpx.AsyncClient, recorder: Recorder, script: List[str], user_id: str,
+                      think_time: float) -> None:
+    """
+    1 セッション分の会話を再生する
+    """
+    if await timed_post(client, recorder, "reset", RequestReset(user_id=user_id).model_dump()) is None:
+        return
+
+    for message in script:
+        body = RequestSendPlayerMessage(message=message, user_id=user_id).model_dump()
+        result = await timed_post(client, recorder, "send_message", body)
+        if result is None:
+            return
+        response, record = result
+        reply = ResponseSendPlayerMessage(**response.json())
+        record["end"] = reply.end
+        if reply.end:
+            return
+        if think_time:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+async def run(args: argparse.Namespace, scripts: List[List[str]]) -> Dict[str, Any]:
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=REQUEST_TIMEOUT_SECONDS, limits=limits) as client:
+        def session(i: int):
+            return run_session(client, recorder, scripts[i % len(scripts)], f"loadtest-{run_id}-{i}", args.think_time)
+
+        started = time.perf_counter()
+        if args.rate:
+            # 到着率モード：応答を待たずにポアソン到着で新しいセッションを始める
+            tasks = []
+            for i in range(args.sessions):
+                tasks.append(asyncio.create_task(session(i)))
+                await asyncio.sleep(random.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+        else:
+            # 同時実行数モード：各仮想ユーザーがセッションを 1 つずつ順に実行する
+            counter = iter(range(args.sessions))
+
+            async def virtual_user():
+                for i in counter:
+                    await session(i)
+
+            await asyncio.gather(*(virtual_user() for _ in range(args.concurrency)))
+        wall_seconds = time.perf_counter() - started
+
+    return {
+        "run_id": run_id,
+        "started_at": started_at,
+        "config": {
+            "url": args.url,
+            "mode": "rate" if args.rate else "concurrency",
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate,
+            "sessions": args.sessions,
+            "think_time": args.think_time,
+            "scripts": args.scripts or "builtin",
+        },
+        "wall_seconds": wall_seconds,
+        **recorder.report(wall_seconds),
+    }
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"--- 負荷試験結果 (run {result['run_id']}, {result['wall_seconds']:.1f}s) ---")
+    for name in ("reset", "send_message", "overall"):
+        s = result[name]
+        lat = s["latency_seconds"]
+        fmt = lambda v: f"{v:.3f}" if v is not None else "-"
+        line = (f"{name}: {s['requests']} req, {s['throughput_rps']:.2f} req/s, "
+                f"error {s['error_rate']:.1%}, p50 {fmt(lat['p50'])}s, p95 {fmt(lat['p95'])}s, p99 {fmt(lat['p99'])}s")
+        if "end_true_share" in s:
+            line += f", end=true {s['end_true_share']:.1%}"
+        print(line)
+    print(f"status: {result['overall']['status_codes']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="server1 の負荷試験")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--concurrency", type=int, default=10, help="同時に会話する仮想ユーザー数")
+    parser.add_argument("--rate", type=float, default=None, help="セッションの到着率（セッション/秒、指定時は到着率モード）")
+    parser.add_argument("--sessions", type=int, default=100, help="再生するセッション数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="発言間の平均待ち時間（秒）")
+    parser.add_argument("--scripts", default=None, help="会話スクリプトの JSONL")
+    parser.add_argument("--output", default=None, help="結果を保存する JSON ファイル")
+    args = parser.parse_args()
+
+    scripts = load_scripts(args.scripts) if args.scripts else DEFAULT_SCRIPTS
+    result = asyncio.run(run(args, scripts))
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+    return 0 if result["overall"]["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
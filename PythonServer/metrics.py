@@ -0,0 +1,248 @@
+# metrics.py
+# 処理段階ごとの所要時間・Ollama のトークン数などを集計し、Prometheus のテキスト形式で出力する
+#  ※ 外部ライブラリ(prometheus_client)は使わず、必要な Counter / Histogram だけを実装している
+#  ※ with stage("moderation"): のように囲んだ区間の時間を計り、その中の Ollama 呼び出しの
+#    トークン数・処理時間を同じ段階(role)として記録する
+#  ※ キュー長・キャッシュ・セッション数などの状態は add_collector() で登録した関数から出力時に読む
+
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+import tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 現在処理中の段階（Ollama 呼び出しのトークン数をどの role として記録するか）
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("current_stage", default="other")
+
+# 出力時に呼ぶ関数（(メトリクス名, 種類, 説明, ラベル, 値) を返す）
+Sample = Tuple[str, str, str, Dict[str, str], float]
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+_registry: List["_Metric"] = []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}"
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # バケットごとの件数 + [合計, 件数]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(data)) for key, data in self._values.items()]
+        lines = []
+        for key, data in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(data[-1])}")
+        return lines
+
+
+# ------------------------------------------------------------
+# 各サーバ共通のメトリクス
+# ------------------------------------------------------------
+
+stage_seconds = Histogram("llm_stage_duration_seconds", "処理段階ごとの所要時間", ["stage"])
+ollama_prompt_tokens = Counter("ollama_prompt_eval_tokens_total", "Ollama が処理した入力トークン数", ["role", "model"])
+ollama_eval_tokens = Counter("ollama_eval_tokens_total", "Ollama が生成した出力トークン数", ["role", "model"])
+ollama_prompt_seconds = Counter("ollama_prompt_eval_duration_seconds_total", "Ollama の入力処理時間", ["role", "model"])
+ollama_eval_seconds = Counter("ollama_eval_duration_seconds_total", "Ollama の生成時間", ["role", "model"])
+ollama_requests = Counter("ollama_requests_total", "Ollama への呼び出し回数", ["role", "model"])
+
+
+@contextmanager
+def stage(name: str):
+    """
+    区間の所要時間を stage として記録し、その間の Ollama 呼び出しを role=name として数える
+    （トレースにも stage.<name> のスパンを作る）
+    """
+    token = current_stage.set(name)
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"stage.{name}"):
+            yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=name)
+        current_stage.reset(token)
+
+
+def staged(name: str):
+    """
+    関数全体を stage(name) で囲むデコレータ（通常の関数・async 関数の両方に使える）
+    """
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_ollama(response: Any) -> None:
+    """
+    Ollama の応答（非ストリームの応答、またはストリームの最後のチャンク）のトークン数・処理時間を記録する
+    """
+    labels = {"role": current_stage.get(), "model": response.get('model') or ""}
+    ollama_requests.inc(**labels)
+    ollama_prompt_tokens.inc(response.get('prompt_eval_count') or 0, **labels)
+    ollama_eval_tokens.inc(response.get('eval_count') or 0, **labels)
+    ollama_prompt_seconds.inc((response.get('prompt_eval_duration') or 0) / 1e9, **labels)
+    ollama_eval_seconds.inc((response.get('eval_duration') or 0) / 1e9, **labels)
+
+
+def add_collector(collect: Callable[[], Iterable[Sample]]) -> None:
+    """
+    出力のたびに呼ばれ、その時点の値（キュー長・キャッシュ件数など）を返す関数を登録する
+    """
+    _collectors.append(collect)
+
+
+def cache_samples(name: str, stats: Dict[str, Any]) -> Iterable[Sample]:
+    """
+    cache.TTLCache / score_cache.ScoreCache の stats() をメトリクスに変換する
+    """
+    labels = {"cache": name}
+    yield ("cache_hits_total", "counter", "キャッシュのヒット数", labels, stats["hits"])
+    yield ("cache_misses_total", "counter", "キャッシュのミス数", labels, stats["misses"])
+    yield ("cache_hit_ratio", "gauge", "キャッシュのヒット率", labels, stats["hit_rate"])
+    yield ("cache_entries", "gauge", "キャッシュの件数", labels, stats["size"])
+
+
+def session_samples(stats: Dict[str, Any]) -> Iterable[Sample]:
+    """
+    session_store.SessionStore の stats() をメトリクスに変換する
+    """
+    yield ("sessions", "gauge", "メモリ上のセッション数", {"state": "total"}, stats["sessions"])
+    yield ("sessions", "gauge", "メモリ上のセッション数", {"state": "active"}, stats["active_sessions"])
+    yield ("session_bytes", "gauge", "セッション履歴のおおよそのメモリ量", {}, stats["bytes"])
+    yield ("session_evictions_total", "counter", "上限超過で捨てたセッション数", {}, stats["evictions"])
+    yield ("session_expirations_total", "counter", "アイドル時間切れで捨てたセッション数", {}, stats["expirations"])
+
+
+def scheduler_samples(stats: Dict[str, Any]) -> Iterable[Sample]:
+    """
+    scheduler.FairScheduler の stats() をメトリクスに変換する
+    """
+    yield ("scheduler_queue_depth", "gauge", "実行枠を待っている Ollama 呼び出し数", {}, stats["queued"])
+    yield ("scheduler_in_flight", "gauge", "実行中の Ollama 呼び出し数", {}, stats["in_flight"])
+    yield ("scheduler_pending_requests", "gauge", "受け付け済みで処理中のリクエスト数", {}, stats["pending_requests"])
+    yield ("scheduler_rejected_total", "counter", "混雑のため断ったリクエスト数", {}, stats["rejected"])
+
+
+def render() -> str:
+    """
+    すべてのメトリクスを Prometheus のテキスト形式で返す
+    """
+    lines: List[str] = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+
+    # 同じ名前のサンプルはまとめて出力する
+    grouped: Dict[str, Tuple[str, str, List[Tuple[Dict[str, str], float]]]] = {}
+    for collect in _collectors:
+        for name, kind, help, labels, value in collect():
+            grouped.setdefault(name, (kind, help, []))[2].append((labels, value))
+    for name, (kind, help, samples) in grouped.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,251 @@
+# mock_ollama.py
+# GPU なしで server1 / evalserver / baseline1 を動かすための Ollama の代用サーバ
+#  ※ /api/chat・/api/generate（ストリーミング含む）・/api/ps・/api/tags・/api/version に応答する
+#  ※ プロンプト処理時間（入力トークン数に比例）と 1 トークンごとの生成時間、同時処理数の上限を再現する
+#  ※ 出力はプロンプトの内容に応じたスクリプト（VALID/INVALID・スコア・返答など）から返す
+#
+# 使い方:
+#   python mock_ollama.py                                   # localhost:11434 で起動
+#   python mock_ollama.py --port 11500 --token-latency 0.05 --parallel 2
+#   python mock_ollama.py --script mock_script.json         # 出力スクリプトを差し替え
+#
+# スクリプトの JSON は [{"match": "正規表現", "response": "出力" または ["候補", ...]}, ...] の形式で、
+# 最後の発言（generate では prompt）に最初にマッチしたものを使います。
+# サーバ側は llm_client.OLLAMA_HOSTS（または環境変数 OLLAMA_HOST）をこのサーバに向けてください。
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import context
+
+# 入力 1 トークンあたりの処理時間・出力 1 トークンあたりの生成時間（秒）
+PROMPT_LATENCY_PER_TOKEN = 0.0005
+TOKEN_LATENCY = 0.02
+
+# モデルを初めて使うときの読み込み時間（秒）
+LOAD_LATENCY = 2.0
+
+# 同時に処理するリクエスト数（OLLAMA_NUM_PARALLEL 相当）と待ち行列の上限（OLLAMA_MAX_QUEUE 相当）
+PARALLEL = 4
+MAX_QUEUE = 512
+
+# 出力スクリプト（上から順に判定）
+DEFAULT_SCRIPT = [
+    {"match": r"content moderator", "response": "VALID"},
+    {"match": r"Analyze the sentiment", "response": ["4", "7", "10", "12"]},
+    {"match": r"要約本文のみ", "response": "ユーザーは学習の続け方について相談しており、AIは具体的な方法を提案した。"},
+    {"match": r"評価結果の整数", "response": ["3", "4", "5"]},
+    {"match": r"", "response": [
+        "なるほど、それは面白いですね！もう少し詳しく教えてもらえますか？",
+        "いい質問ですね。まずは小さな目標を決めて、毎日少しずつ続けるのがおすすめです。",
+        "そうなんですね。どんなところが一番楽しいですか？",
+    ]},
+]
+
+# 出力を 1 トークンずつに分ける（日本語は 1 文字、それ以外は 4 文字程度で 1 トークン: context.estimate_tokens と同じ見積もり）
+_TOKEN = re.compile(r"[぀-ヿ㐀-鿿豈-﫿ｦ-ﾟ]|[^぀-ヿ㐀-鿿豈-﫿ｦ-ﾟ]{1,4}")
+
+app = FastAPI(title="Mock Ollama")
+
+script: List[Dict[str, Any]] = DEFAULT_SCRIPT
+loaded_models: Dict[str, float] = {}      # モデル名 -> 読み込んだ時刻
+_slots: Optional[asyncio.Semaphore] = None
+_waiting = 0
+
+
+def model_tag(name: str) -> str:
+    # Ollama と同じく、タグ省略時は :latest として扱う
+    return name if ":" in name else f"{name}:latest"
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def choose_output(text: str, body: Dict[str, Any]) -> str:
+    """
+    スクリプトから出力を決める（format に JSON スキーマがあればそれに沿った JSON を返す）
+    """
+    schema = body.get("format")
+    if isinstance(schema, dict) and "properties" in schema:
+        return json.dumps({name: random.randint(3, 5) for name in schema["properties"]})
+    for rule in script:
+        if re.search(rule["match"], text):
+            response = rule["response"]
+            return random.choice(response) if isinstance(response, list) else response
+    return ""
+
+
+def overloaded() -> JSONResponse:
+    return JSONResponse(status_code=503, content={"error": "server busy, please try again.  maximum pending requests exceeded"})
+
+
+async def run_model(model: str, prompt_text: str, output: str, stream: bool, make_chunk, make_final):
+    """
+    読み込み → プロンプト処理 → トークン生成 の順に時間をかけて応答する
+    make_chunk(token) / make_final(stats) で API ごとの JSON を作る
+    """
+    if _waiting >= MAX_QUEUE:
+        return overloaded()
+
+    model = model_tag(model)
+    tokens = _TOKEN.findall(output)
+    prompt_tokens = context.estimate_tokens(prompt_text)
+
+    async def generate():
+        global _waiting
+        started = time.monotonic()
+        _waiting += 1
+        try:
+            await _slots.acquire()
+        finally:
+            _waiting -= 1
+        try:
+            load_seconds = 0.0
+            if model not in loaded_models:
+                load_seconds = LOAD_LATENCY
+                await asyncio.sleep(LOAD_LATENCY)
+                loaded_models[model] = time.time()
+
+            prompt_seconds = prompt_tokens * PROMPT_LATENCY_PER_TOKEN
+            await asyncio.sleep(prompt_seconds)
+
+            eval_started = time.monotonic()
+            for token in tokens:
+                await asyncio.sleep(TOKEN_LATENCY)
+                if stream:
+                    yield make_chunk(token)
+            eval_seconds = time.monotonic() - eval_started
+        finally:
+            _slots.release()
+
+        yield make_final({
+            "done": True,
+            "done_reason": "stop" if tokens else "load",
+            "total_duration": int((time.monotonic() - started) * 1e9),
+            "load_duration": int(load_seconds * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(eval_seconds * 1e9),
+        })
+
+    if stream:
+        return StreamingResponse(
+            (json.dumps(part, ensure_ascii=False) + "\n" async for part in generate()),
+            media_type="application/x-ndjson",
+        )
+    parts = [part async for part in generate()]
+    return parts[-1]
+
+
+@app.post("/api/chat")
+async def api_chat(request: Request):
+    body = await request.json()
+    model = body.get("model", "")
+    messages = body.get("messages") or []
+    stream = body.get("stream", True)
+
+    prompt_text = "\n".join(m.get("content", "") for m in messages)
+    output = choose_output(messages[-1].get("content", ""), body) if messages else ""
+
+    def make_chunk(token):
+        return {"model": model, "created_at": now_iso(),
+                "message": {"role": "assistant", "content": token}, "done": False}
+
+    def make_final(stats):
+        return {"model": model, "created_at": now_iso(),
+                "message": {"role": "assistant", "content": "" if stream else output}, **stats}
+
+    return await run_model(model, prompt_text, output, stream, make_chunk, make_final)
+
+
+@app.post("/api/generate")
+async def api_generate(request: Request):
+    body = await request.json()
+    model = body.get("model", "")
+    prompt = body.get("prompt") or ""
+    stream = body.get("stream", True)
+
+    # 空のプロンプトはモデルの読み込みだけを行う
+    output = choose_output(prompt, body) if prompt else ""
+
+    def make_chunk(token):
+        return {"model": model, "created_at": now_iso(), "response": token, "done": False}
+
+    def make_final(stats):
+        return {"model": model, "created_at": now_iso(), "response": "" if stream else output, **stats}
+
+    return await run_model(model, prompt, output, stream, make_chunk, make_final)
+
+
+def model_info(name: str, loaded_at: float) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "model": name,
+        "modified_at": datetime.fromtimestamp(loaded_at, timezone.utc).isoformat(),
+        "size": 0,
+        "digest": "mock",
+        "details": {"format": "gguf", "family": "mock", "parameter_size": "0B", "quantization_level": "mock"},
+    }
+
+
+@app.get("/api/ps")
+async def api_ps():
+    return {"models": [{**model_info(name, t), "size_vram": 0, "expires_at": now_iso()}
+                       for name, t in loaded_models.items()]}
+
+
+@app.get("/api/tags")
+async def api_tags():
+    return {"models": [model_info(name, t) for name, t in loaded_models.items()]}
+
+
+@app.get("/api/version")
+async def api_version():
+    return {"version": "0.0.0-mock"}
+
+
+@app.on_event("startup")
+async def startup():
+    global _slots
+    _slots = asyncio.Semaphore(PARALLEL)
+
+
+def main():
+    global PROMPT_LATENCY_PER_TOKEN, TOKEN_LATENCY, LOAD_LATENCY, PARALLEL, MAX_QUEUE, script
+    parser = argparse.ArgumentParser(description="Ollama の代用サーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--prompt-latency", type=float, default=PROMPT_LATENCY_PER_TOKEN, help="入力 1 トークンあたりの秒数")
+    parser.add_argument("--token-latency", type=float, default=TOKEN_LATENCY, help="出力 1 トークンあたりの秒数")
+    parser.add_argument("--load-latency", type=float, default=LOAD_LATENCY, help="モデル読み込みの秒数")
+    parser.add_argument("--parallel", type=int, default=PARALLEL, help="同時に処理するリクエスト数")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE, help="待ち行列の上限（超えたら 503）")
+    parser.add_argument("--script", default=None, help="出力スクリプトの JSON")
+    args = parser.parse_args()
+
+    PROMPT_LATENCY_PER_TOKEN = args.prompt_latency
+    TOKEN_LATENCY = args.token_latency
+    LOAD_LATENCY = args.load_latency
+    PARALLEL = args.parallel
+    MAX_QUEUE = args.max_queue
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
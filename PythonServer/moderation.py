@@ -0,0 +1,105 @@
+# moderation.py
+# check_input_validity の前段に置くローカルな入力チェック
+#  明らかに不適切な入力（ボットに向けた暴言）と、明らかに問題ない短い定型句はここで確定させ、
+#  判断がつかない入力だけを LLM のモデレーションに回す
+#  ※ 相談の中で言われた言葉を引用する入力（「上司にうざいと言われた」など）は拒否せず LLM に回す
+
+import re
+import unicodedata
+from typing import Dict, Optional
+
+# 二人称（THREAT_TARGETS）の直後に暴言（THREAT_WORDS）が続く入力だけを即 INVALID とする
+#  ※ 暴言の語だけでは拒否しない（相談の中の引用や自分の気持ちの表現と区別できないため）
+#  ※ 「〜と言われた」「〜って言ってきた」のように引用として続く場合も拒否しない
+THREAT_TARGETS = ["お前", "おまえ", "オマエ", "てめえ", "てめぇ", "てめー", "テメエ", "テメー", "貴様", "きさま"]
+THREAT_WORDS = ["死ね", "氏ね", "しね", "殺す", "ころす", "ぶっ殺", "ぶっころ", "クズ", "くず"]
+
+# 完全一致（記号・空白を除いて比較）なら即 VALID とする短い定型句
+ALLOWLIST = [
+    "はい", "いいえ", "うん", "ううん", "ええ", "そうです", "そうですね", "そうなんです",
+    "こんにちは", "こんばんは", "おはよう", "おはようございます", "はじめまして",
+    "よろしく", "よろしくお願いします", "よろしくおねがいします",
+    "ありがとう", "ありがとうございます", "ありがとうございました",
+    "なるほど", "わかりました", "分かりました", "了解です", "大丈夫です",
+    "さようなら", "またね", "おつかれさまです", "お疲れ様です", "終了",
+    "hello", "hi", "yes", "no", "thanks", "thankyou",
+]
+
+# 意味のない入力とみなすヒューリスティクス
+#  ※ 数字（時刻・日付・金額など）は文字として数え、記号・絵文字は割合の計算に含めない
+#  ※ 記号・絵文字だけの入力はここでは決めずに LLM に回す
+MAX_REPEAT_RUN = 8          # 同じ文字（数字・長音・w 以外）がこの回数以上連続したら無意味とみなす
+MIN_LETTER_RATIO = 0.3      # 記号を除いた部分のうち、文字（かな・漢字・英字・数字）の割合がこれ未満なら無意味とみなす
+MIN_LENGTH_FOR_RATIO = 4    # 短すぎる入力には割合判定をかけない
+
+_PUNCTUATION = re.compile(r"[\s\W_]+")
+#  ※ 「すごーーーーい」「wwwwwwww」のような感情表現は無意味とみなさない（〜・！ は記号として除かれる）
+_REPEAT_RUN = re.compile(r"([^\dーw])\1{%d,}" % (MAX_REPEAT_RUN - 1))
+_LETTER = re.compile(r"[ぁ-ゖァ-ヺー一-龯々a-z0-9]")
+_CONSONANT_MASH = re.compile(r"[bcdfghjklmnpqrstvxz]{7,}")
+
+
+def _alternation(words) -> str:
+    return "|".join(re.escape(unicodedata.normalize("NFKC", w)) for w in sorted(words, key=len, reverse=True))
+
+
+# ボットに向けた暴言は 1 本の正規表現にまとめてコンパイルし、1 回の走査で判定する
+#  例: 「お前死ね」「おまえなんか殺すぞ」は拒否、「お前は死ねと言われた」は LLM に回す
+_threat_pattern = re.compile(
+    r"(?:%s)(?:なんか|みたいな(?:やつ|奴)?|は|も|を|が)?[\s、,。.!?]*(?:%s)"
+    r"(?![ぁ-ゖ]{0,4}[\s」』\"”]*(?:と|って|っつって))"
+    % (_alternation(THREAT_TARGETS), _alternation(THREAT_WORDS))
+)
+_allowlist = {_PUNCTUATION.sub("", unicodedata.normalize("NFKC", w).lower()) for w in ALLOWLIST}
+
+# 判定結果ごとの件数（allowed + blocked が LLM 呼び出しを省略できた回数）
+_stats: Dict[str, int] = {"allowed": 0, "blocked": 0, "deferred": 0}
+
+
+def normalize(text: str) -> str:
+    """
+    全角/半角・大文字/小文字の揺れを吸収する
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def is_nonsense(normalized: str) -> bool:
+    """
+    長さ・文字種のヒューリスティクスで意味のない入力かを判定する
+    """
+    compact = _PUNCTUATION.sub("", normalized)
+    if not compact:
+        return False  # 記号・絵文字だけの入力は判断せず LLM に回す
+    if _REPEAT_RUN.search(compact) or _CONSONANT_MASH.search(compact):
+        return True
+    if len(compact) >= MIN_LENGTH_FOR_RATIO:
+        letters = len(_LETTER.findall(compact))
+        if letters / len(compact) < MIN_LETTER_RATIO:
+            return True
+    return False
+
+
+def prefilter(text: str) -> Optional[bool]:
+    """
+    ローカルで判定できる入力の結果を返す
+    (True: 適切, False: 不適切, None: 判断できないので LLM に回す)
+    """
+    normalized = normalize(text)
+
+    if _threat_pattern.search(normalized) or is_nonsense(normalized):
+        _stats["blocked"] += 1
+        return False
+
+    if _PUNCTUATION.sub("", normalized) in _allowlist:
+        _stats["allowed"] += 1
+        return True
+
+    _stats["deferred"] += 1
+    return None
+
+
+def stats() -> Dict[str, int]:
+    """
+    判定件数と、LLM 呼び出しを省略できた回数(saved_calls)を返す
+    """
+    return {**_stats, "saved_calls": _stats["allowed"] + _stats["blocked"]}
@@ -0,0 +1,131 @@
+# prompt_regression.py
+# prompts.py の評価用プロンプトを「共通の先頭部分 + 観点ごとの末尾部分」の構成に変えても
+# スコアが変わらないことを確認するための回帰チェック
+#
+# 使い方:
+#   python prompt_regression.py                 # 組み込みのサンプル会話で比較
+#   python prompt_regression.py cases.jsonl     # EvaluationRequest 形式の JSONL で比較
+#
+# 旧構成（観点ごとの説明が先頭、会話ログが末尾）のテンプレートは、git の LEGACY_REF 時点の
+# prompts.py から読み込みます（git リポジトリ内で実行してください）。
+
+import json
+import os
+import re
+import subprocess
+import sys
+
+import ollama
+import prompts
+
+MODEL_NAME = "hf.co/mmnga/Llama-3.1-Swallow-8B-Instruct-v0.5-gguf"
+
+# この一致率を下回ったら終了コード 1 で終わる
+MIN_AGREEMENT = 0.9
+
+# 比較対象の旧構成のテンプレートを取り出すコミット（プロンプトの構成を変える前）
+LEGACY_REF = "6d3ce52"
+LEGACY_PATH = "PythonServer/prompts.py"
+
+
+def load_legacy_prompts(ref: str = LEGACY_REF) -> dict:
+    """
+    git show <ref>:PythonServer/prompts.py を読み込み、旧構成の prompt_* を返す
+    """
+    source = subprocess.run(
+        ["git", "show", f"{ref}:{LEGACY_PATH}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, encoding="utf-8", check=True,
+    ).stdout
+    namespace: dict = {}
+    exec(compile(source, f"{ref}:{LEGACY_PATH}", "exec"), namespace)
+    return {name: value for name, value in namespace.items() if name.startswith("prompt_")}
+
+
+# 比較する観点（旧・新それぞれの prompts.prompt_<名前> を使う）
+CRITERIA = ["relevance", "clarity", "attitude"]
+
+# 組み込みの回帰セット
+SAMPLE_LOG = """
+    User: こんにちは。
+    Mentor: こんにちは。本日はどのような件でしょうか？
+    User: プロジェクトの報告です。
+    Mentor: わかりました。では、プロジェクトの進捗はどうですか？遅れの原因があれば教えてください。
+    """
+
+DEFAULT_CASES = [
+    {
+        "before_response": "プロジェクトの進捗はどうですか？遅れの原因があれば教えてください。",
+        "userinput1": "すいません、ちょっと遅れてます。でもまあなんとかなると思います。",
+        "response1": "遅れていることは把握しました。「なんとかなる」の根拠や、具体的な遅延理由をもう少し詳しく教えていただけますか？",
+        "log": SAMPLE_LOG,
+    },
+    {
+        "before_response": "プロジェクトの進捗はどうですか？遅れの原因があれば教えてください。",
+        "userinput1": "結論から言うと2日遅れています。原因は外部APIの仕様変更で、明日までに対応方針をまとめます。",
+        "response1": "状況と原因、次の行動まで明確ですね。対応方針がまとまったら共有してください。",
+        "log": SAMPLE_LOG,
+    },
+    {
+        "before_response": "プロジェクトの進捗はどうですか？遅れの原因があれば教えてください。",
+        "userinput1": "昨日の夕飯はカレーでした。",
+        "response1": "夕飯の話ではなく、プロジェクトの進捗について教えていただけますか？",
+        "log": SAMPLE_LOG,
+    },
+    {
+        "before_response": "最近の仕事で楽しかったことはありますか？",
+        "userinput1": "バグを直したら別のバグが出てきて、まるでモグラたたきの名人になった気分です。",
+        "response1": "モグラたたきの名人ですね！その中で一番手ごわかったバグは何でしたか？",
+        "log": "\n    User: こんにちは。\n    Mentor: こんにちは！最近の仕事で楽しかったことはありますか？\n",
+    },
+]
+
+
+def score(template: str, case: dict) -> int:
+    """
+    テンプレートに会話データを埋め込んで評価し、スコア(1-5, 失敗時 0)を返す
+    """
+    response = ollama.generate(
+        model=MODEL_NAME,
+        prompt=template.format(**case),
+        options={"temperature": 0.0},
+    )
+    match = re.search(r'[1-5]', response['response'])
+    return int(match.group(0)) if match else 0
+
+
+def load_cases(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main() -> int:
+    cases = load_cases(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CASES
+    keys = ("before_response", "userinput1", "response1", "log")
+    legacy = load_legacy_prompts()
+
+    all_agree = True
+    print(f"--- 回帰チェック開始 (Model: {MODEL_NAME}, {len(cases)} 件) ---")
+    for name in CRITERIA:
+        legacy_template = legacy[f"prompt_{name}"]
+        new_template = getattr(prompts, f"prompt_{name}")
+        same = 0
+        diff_total = 0
+        for case in cases:
+            data = {k: case[k] for k in keys}
+            old_score = score(legacy_template, data)
+            new_score = score(new_template, data)
+            same += old_score == new_score
+            diff_total += abs(old_score - new_score)
+
+        agreement = same / len(cases)
+        mean_diff = diff_total / len(cases)
+        print(f"{name}: 一致率 {agreement:.2%}, 平均差 {mean_diff:.2f}")
+        all_agree &= agreement >= MIN_AGREEMENT
+
+    print("--- 回帰チェック終了 ---")
+    return 0 if all_agree else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,33 @@
 # prompts.py
 
 # 共通の変数として {before_response}, {userinput1}, {response1}, {log} を受け取る形式にします
+#
+# 評価用プロンプトは「共通の先頭部分(prompt_prefix)」+「観点ごとの末尾部分」で組み立てます。
+# 先頭部分（メンターの役割・会話全ログ）をすべての観点でバイト単位で同一にしておくと、
+# Ollama(llama.cpp) のプロンプトキャッシュが観点間で再利用され、長いログの処理が 1 回で済みます。
+# 観点ごとの違いは必ず末尾部分に書いてください。
+# 末尾部分は元の観点別プロンプトの文言（評価手法・直近の会話・出力ルール）をそのまま使っています。
+# 文言や構成を変えたときは prompt_regression.py で変更前とのスコアの一致を確認してください。
+
+# 全観点で共通の先頭部分
+prompt_prefix = """
+あなたはコミュニケーションメンターです。
+
+## 過去の会話全ログ
+{log}
+"""
+
+
+def build_prompt(suffix: str) -> str:
+    """
+    共通の先頭部分に観点ごとの末尾部分をつなげた評価用テンプレートを返す
+    """
+    return prompt_prefix + suffix
 
+
+# 観点ごとの末尾部分
 # 観点1: 回答の的確性 (Relevance)
-prompt_relevance = """
-あなたはコミュニケーションメンターです。
+criterion_relevance = """
 コミュニケーションの評価手法に従って、ユーザー返答のコミュニケーションについて評価してください。
 
 ## 評価手法：【回答の的確性】
@@ -23,16 +46,12 @@ prompt_relevance = """
 ユーザー回答：{userinput1}
 メンターの応答：{response1}
 
-## 過去の会話全ログ
-{log}
-
 ## 出力ルール
 余計な文字は一切含めず、評価結果の整数（1~5）のみを出力してください。
 """
 
 # 観点2: 論理性・わかりやすさ (Clarity)
-prompt_clarity = """
-あなたはコミュニケーションメンターです。
+criterion_clarity = """
 コミュニケーションの評価手法に従って、ユーザーの返答について評価してください。
 
 ## 評価手法：【論理性・わかりやすさ】
@@ -51,16 +70,12 @@ prompt_clarity = """
 ユーザー回答：{userinput1}
 メンターの応答：{response1}
 
-## 過去の会話全ログ
-{log}
-
 ## 出力ルール
 余計な文字は一切含めず、評価結果の整数（1~5）のみを出力してください。
 """
 
 # 観点3: 態度・協調性 (Attitude)
-prompt_attitude = """
-あなたはコミュニケーションメンターです。
+criterion_attitude = """
 コミュニケーションにおける「ユーモア・面白さ・ウィット」の評価手法に従って、ユーザーの発話について評価してください。
 
 ## 評価手法：【ユーモア・ウィット】
@@ -76,13 +91,56 @@ prompt_attitude = """
 ユーザーの回答：{userinput1}
 メンターの応答：{response1}
 
-## 過去の会話全ログ
-{log}
-
 ## 出力ルール
 余計な文字は一切含めず、評価結果の整数（1~5）のみを出力してください。
 """
 
+# 3観点をまとめて 1 回で評価する (Fused)
+#  出力は JSON スキーマで {"relevance": n, "clarity": n, "attitude": n} に制約する
+criterion_fused = """
+以下の3つの評価手法に従って、ユーザー返答のコミュニケーションをそれぞれ5段階で評価してください。
+
+## 評価手法1：【回答の的確性】(relevance)
+相手の質問に対して、ズレのない適切な回答ができているかを評価します。
+
+5: 相手の質問の意図を完全に理解し、的確かつ過不足ない回答をしている。
+4: 概ね的確だが、わずかに焦点がずれている、または情報が少し足りない/多い。
+3: 質問の意図をくみ取れていない部分がある。論点が少しずれている。冗長である。
+2: 相手の質問とは大きく異なる話をしている。論点がすり替わっている。
+1: 相手の質問に回答する気がない。全く関係のない話をしている。
+
+## 評価手法2：【論理性・わかりやすさ】(clarity)
+話の構成が整理されており、相手にとって理解しやすいかを評価します。
+
+5: 論理構成が明確で、結論から話すなど非常にわかりやすい。具体例もあり説得力がある。
+4: 理解はできるが、構成にもう少し工夫（結論ファーストなど）があればなお良い。
+3: 話がやや散漫で、要点をつかむのに少し労力がいる。主語の欠落や説明不足がある。
+2: 話の順序が支離滅裂で、何を伝えたいのか理解するのが難しい。
+1: 文法が崩壊している、または意味不明な単語の羅列で理解不能。
+
+## 評価手法3：【ユーモア・ウィット】(attitude)
+発話がどれだけ知的で楽しく、センスあるユーモアを含んでいるかを評価します。
+
+5: 洗練されたユーモアやウィットが自然に盛り込まれ、会話を豊かにしている。
+1: 不快感を与えるジョーク、稚拙すぎる言い回し、あるいはユーモアとして成立していない。
+
+メンターの質問とユーザーの回答とメンターの応答の様子をみて、上記観点で評価してください。
+
+## 直近の会話
+メンターの質問：{before_response}
+ユーザー回答：{userinput1}
+メンターの応答：{response1}
+
+## 出力ルール
+次の形式の JSON のみを出力してください。各値は評価結果の整数（1~5）です。
+{{"relevance": 整数, "clarity": 整数, "attitude": 整数}}
+"""
+
+prompt_relevance = build_prompt(criterion_relevance)
+prompt_clarity = build_prompt(criterion_clarity)
+prompt_attitude = build_prompt(criterion_attitude)
+prompt_fused = build_prompt(criterion_fused)
+
 
 prompt_face="""
 あなたはAIカウンセリングチャットボット（表情付き）です。
@@ -138,5 +196,21 @@ prompt_res="""
 
 """
 
+# 長い会話の履歴を要約する（古い発言を 1 つの要約メッセージにまとめる）
+prompt_summary="""
+以下はユーザーとAIアシスタントの会話です。
+これまでの要約と新しい会話の内容を統合し、1つの要約にまとめてください。
+ユーザーについて分かった事実・目標・関心、話題の流れ、未解決の質問を優先して残してください。
+
+## これまでの要約
+{summary}
+
+## 新しい会話
+{conversation}
+
+## 出力ルール
+要約本文のみを、日本語で300字以内で出力してください。
+"""
+
 prompt_init="""
 こんにちは！今日はどんなお話をしましょう？"""
\ No newline at end of file
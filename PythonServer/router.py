@@ -0,0 +1,230 @@
+# router.py
+# 複数の Ollama ホストに呼び出しを振り分けるクライアント
+#  ※ 定期的に各ホストの状態(/api/ps)を確認し、読み込み済みモデルを把握する
+#  ※ 呼び出しは「そのモデルを読み込み済み」で「処理中の呼び出しが最も少ない」ホストに送る
+#  ※ ホストが応答しなければ一定時間振り分け対象から外し(退避)、別のホストで 1 回だけ再試行する
+#  ※ 振り分け先のホストと再試行は現在のスパン（llm_client の ollama.* スパン）に記録する
+
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+import ollama
+
+import tracing
+
+DEFAULT_HOST = "http://localhost:11434"  # host も環境変数 OLLAMA_HOST も無い場合の接続先（表示用）
+DEFAULT_EJECT_SECONDS = 30
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT_SECONDS = 5
+
+
+def normalize_model(name: str) -> str:
+    """
+    タグ省略時は :latest として扱う（"llama3.2" と "llama3.2:latest" を同じモデルとみなす）
+    """
+    return name if ":" in name else f"{name}:latest"
+
+
+def is_host_failure(e: Exception) -> bool:
+    """
+    ホスト側の障害（接続できない・タイムアウト・5xx）かどうか
+    """
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code >= 500
+    return isinstance(e, (ConnectionError, httpx.TransportError, asyncio.TimeoutError))
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    別のホストなら成功しうるエラーかどうか（モデルが無い 404 も含む）
+    """
+    if isinstance(e, ollama.ResponseError) and e.status_code == 404:
+        return True
+    return is_host_failure(e)
+
+
+class Endpoint:
+    """
+    1 台の Ollama ホストと、その状態（処理中の数・退避期限・読み込み済みモデル）
+    """
+
+    def __init__(self, host: Optional[str], limits: httpx.Limits):
+        self.client = ollama.AsyncClient(host=host, limits=limits)
+        # ログ・統計に出すホスト名（AsyncClient と同じく、未指定なら環境変数 OLLAMA_HOST を使う）
+        self.host = host or os.environ.get("OLLAMA_HOST") or DEFAULT_HOST
+        self.outstanding = 0
+        self.ejected_until = 0.0
+        self.loaded_models: set = set()
+        self.requests = 0
+        self.failures = 0
+
+    def is_available(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def eject(self, seconds: float) -> None:
+        self.ejected_until = time.monotonic() + seconds
+        self.failures += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.is_available(),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+
+class OllamaRouter:
+    """
+    ホストの一覧を受け取り、呼び出しごとに振り分け先を選ぶ
+    hosts に None を含めると環境変数 OLLAMA_HOST（未設定なら localhost:11434）を使う
+    """
+
+    def __init__(self, hosts: Sequence[Optional[str]], limits: httpx.Limits,
+                 eject_seconds: float = DEFAULT_EJECT_SECONDS,
+                 health_check_interval: float = DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.endpoints = [Endpoint(host, limits) for host in hosts]
+        self.eject_seconds = eject_seconds
+        self.health_check_interval = health_check_interval
+        self._health_task: Optional[asyncio.Task] = None
+        self._retries = 0
+
+    def pick(self, model: Optional[str], exclude: Sequence[Endpoint] = ()) -> Optional[Endpoint]:
+        """
+        振り分け先を選ぶ（退避中しか残っていなければ退避中のホストも候補にする）
+        """
+        candidates = [ep for ep in self.endpoints if ep not in exclude]
+        available = [ep for ep in candidates if ep.is_available()] or candidates
+        if not available:
+            return None
+        if model:
+            key = normalize_model(model)
+            loaded = [ep for ep in available if key in ep.loaded_models]
+            available = loaded or available
+        return min(available, key=lambda ep: ep.outstanding)
+
+    async def request(self, method: str, kwargs: Dict[str, Any]):
+        """
+        client.chat / client.generate 等を振り分け先で呼ぶ（失敗したら別のホストで 1 回再試行）
+        """
+        self._ensure_health_checks()
+        tried: List[Endpoint] = []
+        while True:
+            endpoint = self.pick(kwargs.get('model'), exclude=tried)
+            tried.append(endpoint)
+            tracing.set_attribute("ollama.host", endpoint.host)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                response = await getattr(endpoint.client, method)(**kwargs)
+            except Exception as e:
+                if not self._after_failure(endpoint, e, tried):
+                    raise
+                continue
+            finally:
+                endpoint.outstanding -= 1
+            if kwargs.get('model'):
+                endpoint.loaded_models.add(normalize_model(kwargs['model']))
+            return response
+
+    async def stream(self, method: str, kwargs: Dict[str, Any]):
+        """
+        ストリーミング版（最初のチャンクが届く前の失敗だけ別のホストで再試行する）
+        """
+        self._ensure_health_checks()
+        tried: List[Endpoint] = []
+        while True:
+            endpoint = self.pick(kwargs.get('model'), exclude=tried)
+            tried.append(endpoint)
+            tracing.set_attribute("ollama.host", endpoint.host)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            started = False
+            try:
+                async for chunk in await getattr(endpoint.client, method)(**kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not self._after_failure(endpoint, e, tried):
+                    raise
+            finally:
+                endpoint.outstanding -= 1
+
+    def _after_failure(self, endpoint: Endpoint, e: Exception, tried: List[Endpoint]) -> bool:
+        """
+        失敗したホストを必要なら退避させ、再試行するかどうかを返す
+        """
+        if is_host_failure(e):
+            print(f"Ollama host {endpoint.host} failed, ejecting for {self.eject_seconds}s: {e!r}")
+            endpoint.eject(self.eject_seconds)
+        if len(tried) >= 2 or not is_retryable(e) or self.pick(None, exclude=tried) is None:
+            return False
+        self._retries += 1
+        tracing.add_event("retry", **{"ollama.host": endpoint.host, "error": repr(e)})
+        return True
+
+    async def broadcast(self, method: str, kwargs: Dict[str, Any]) -> Dict[str, Optional[Exception]]:
+        """
+        すべてのホストで同じ呼び出しを行う（ウォームアップ用）
+        戻り値はホスト -> 例外（成功なら None）
+        """
+        async def call(endpoint: Endpoint) -> Optional[Exception]:
+            try:
+                await getattr(endpoint.client, method)(**kwargs)
+            except Exception as e:
+                return e
+            if kwargs.get('model'):
+                endpoint.loaded_models.add(normalize_model(kwargs['model']))
+            return None
+
+        results = await asyncio.gather(*(call(ep) for ep in self.endpoints))
+        return {ep.host: result for ep, result in zip(self.endpoints, results)}
+
+    async def check_health(self) -> None:
+        """
+        各ホストの /api/ps を呼び、読み込み済みモデルを更新する（応答が無ければ退避）
+        """
+        async def check(endpoint: Endpoint) -> None:
+            try:
+                response = await asyncio.wait_for(endpoint.client.ps(), timeout=HEALTH_CHECK_TIMEOUT_SECONDS)
+            except Exception as e:
+                if endpoint.is_available():
+                    print(f"Ollama host {endpoint.host} health check failed: {e!r}")
+                endpoint.eject(self.eject_seconds)
+                return
+            endpoint.loaded_models = {normalize_model(m['model']) for m in response['models']}
+            endpoint.ejected_until = 0.0
+
+        await asyncio.gather(*(check(ep) for ep in self.endpoints))
+
+    def _ensure_health_checks(self) -> None:
+        # 最初の呼び出し時に、そのイベントループ上で定期チェックを開始する
+        task = self._health_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._health_task = asyncio.ensure_future(self._run_health_checks())
+
+    async def _run_health_checks(self) -> None:
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_check_interval)
+
+    async def close(self) -> None:
+        """
+        定期チェックを止める（サーバ終了時に呼ぶ。次の呼び出しがあれば再び開始する）
+        """
+        task = self._health_task
+        self._health_task = None
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self._retries,
+            "hosts": {ep.host: ep.stats() for ep in self.endpoints},
+        }
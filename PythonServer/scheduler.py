@@ -0,0 +1,228 @@
+# scheduler.py
+# Ollama への呼び出しをユーザーごとの待ち行列に積み、ユーザー間で順番(ラウンドロビン)に実行する
+#  ※ 同時に Ollama へ投げる数を MAX_IN_FLIGHT 件に抑え、1 人が大量に送っても他のユーザーを待たせない
+#  ※ 待ち行列・同じユーザーの処理中リクエストが上限を超えていたら、受付時点で Overloaded を投げて
+#    タイムアウトまで待たせずにすぐ断る（受け付けたリクエストはその時点から処理中として数える）
+#  ※ どのユーザーの呼び出しかは current_user（contextvars）で受け渡す
+#  ※ low_priority が True の呼び出し（バックグラウンドの評価など）は、会話の呼び出しが待っていない時だけ、
+#    MAX_BACKGROUND_IN_FLIGHT 件までの枠で実行する（会話の応答を遅らせない）
+
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_QUEUE = 64            # Ollama 呼び出しの待ち行列の上限（超えたら 503）
+DEFAULT_MAX_PENDING_PER_USER = 4  # 1 ユーザーの処理中・順番待ちリクエスト数の上限（超えたら 429）
+DEFAULT_MAX_BACKGROUND_IN_FLIGHT = 1  # 低優先度の呼び出しに使ってよい枠の数
+
+# 処理時間の移動平均の重み（Retry-After の見積もりに使う）
+EWMA_ALPHA = 0.2
+
+# 現在処理中のリクエストのユーザー（未設定の呼び出しは 1 つの共有ユーザーとして扱う）
+current_user: contextvars.ContextVar[str] = contextvars.ContextVar("current_user", default="")
+
+# 現在の処理が低優先度（バックグラウンド）かどうか
+low_priority: contextvars.ContextVar[bool] = contextvars.ContextVar("low_priority", default=False)
+
+
+class Overloaded(Exception):
+    """
+    待ち行列が上限を超えているため受け付けられない
+    status_code は 429（そのユーザーが多すぎる）か 503（サーバ全体が混んでいる）
+    """
+
+    def __init__(self, status_code: int, retry_after: int):
+        super().__init__(f"scheduler overloaded ({status_code}), retry after {retry_after}s")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    受け付けたリクエスト 1 件分（release() するまで、そのユーザーの処理中リクエストとして数える）
+    with 文で使うと抜けるときに release() する。release() は何度呼んでもよい
+    """
+
+    def __init__(self, scheduler: "FairScheduler", user_id: str):
+        self._scheduler = scheduler
+        self.user_id = user_id
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._scheduler._finish(self.user_id)
+
+    def __enter__(self) -> "Admission":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class FairScheduler:
+    """
+    ユーザーごとの待ち行列をラウンドロビンで処理し、同時実行数を制限する
+    """
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, max_queue: int = DEFAULT_MAX_QUEUE,
+                 max_pending_per_user: int = DEFAULT_MAX_PENDING_PER_USER,
+                 max_background_in_flight: int = DEFAULT_MAX_BACKGROUND_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_pending_per_user = max_pending_per_user
+        self.max_background_in_flight = max_background_in_flight
+        self._in_flight = 0
+        self._background_in_flight = 0  # _in_flight のうち低優先度の呼び出しの数
+        self._background: Deque[asyncio.Future] = deque()  # 低優先度の呼び出しの待ち行列（到着順）
+        self._pending: Dict[str, int] = {}  # user_id -> 受け付け済みで終わっていないリクエスト数
+        # user_id -> 待っている Future の列（次に順番が来るユーザーが先頭）
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued = 0
+        self._service_seconds = 1.0
+        self._completed = 0
+        self._rejected = 0
+
+    def queue_depth(self, user_id: Optional[str] = None) -> int:
+        if user_id is None:
+            return self._queued
+        queue = self._queues.get(user_id)
+        return len(queue) if queue else 0
+
+    def retry_after(self) -> int:
+        """
+        今の待ち行列がはけるまでのおおよその秒数
+        """
+        waves = (self._queued + self._in_flight) / self.max_in_flight
+        return max(1, round(waves * self._service_seconds))
+
+    def admit(self, user_id: str) -> Admission:
+        """
+        新しいリクエストを受け付ける（受け付けられなければ Overloaded）
+        受け付けた時点でそのユーザーの処理中リクエストとして数え、返した Admission の release() で外す
+        """
+        if self._pending.get(user_id, 0) >= self.max_pending_per_user:
+            self._rejected += 1
+            raise Overloaded(429, self.retry_after())
+        if self._queued >= self.max_queue:
+            self._rejected += 1
+            raise Overloaded(503, self.retry_after())
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        return Admission(self, user_id)
+
+    def _finish(self, user_id: str) -> None:
+        self._pending[user_id] -= 1
+        if not self._pending[user_id]:
+            del self._pending[user_id]
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, background: bool = False):
+        """
+        実行枠を 1 つ確保している間だけ中の処理を行う（background=True は低優先度）
+        """
+        if background:
+            await self._acquire_background()
+        else:
+            await self._acquire(user_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self._service_seconds += EWMA_ALPHA * (elapsed - self._service_seconds)
+            self._completed += 1
+            self._release(background)
+
+    async def _acquire_background(self) -> None:
+        if self._in_flight < self.max_in_flight and not self._queued and not self._background \
+                and self._background_in_flight < self.max_background_in_flight:
+            self._in_flight += 1
+            self._background_in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._background.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(background=True)
+            elif future in self._background:
+                self._background.remove(future)
+            raise
+
+    async def _acquire(self, user_id: str) -> None:
+        if self._in_flight < self.max_in_flight and not self._queued:
+            self._in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append(future)
+        self._queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を渡された直後に取り消された場合は、その枠を次に回す
+                self._release(background=False)
+            else:
+                self._remove(user_id, future)
+            raise
+
+    def _remove(self, user_id: str, future: asyncio.Future) -> None:
+        queue = self._queues.get(user_id)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self._queued -= 1
+        if not queue:
+            del self._queues[user_id]
+
+    def _release(self, background: bool) -> None:
+        """
+        枠を返し、待っているユーザーがいれば順番が来たユーザーの先頭に渡す
+        （会話の呼び出しが待っていなければ、低優先度の呼び出しに渡す）
+        """
+        if background:
+            self._background_in_flight -= 1
+        while self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self._queued -= 1
+            # このユーザーは末尾に回し、次は別のユーザーを先に処理する
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if not future.done():
+                future.set_result(None)  # 実行中の数はそのまま引き継ぐ
+                return
+        while self._background and self._background_in_flight < self.max_background_in_flight:
+            future = self._background.popleft()
+            if not future.done():
+                self._background_in_flight += 1
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "waiting_users": len(self._queues),
+            "pending_requests": sum(self._pending.values()),
+            "background_in_flight": self._background_in_flight,
+            "background_queued": len(self._background),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "mean_service_seconds": self._service_seconds,
+        }
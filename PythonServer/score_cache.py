@@ -0,0 +1,131 @@
+# score_cache.py
+# 評価スコアをディスク(SQLite)に保存して使い回すキャッシュ
+#  キーは「モデル名・プロンプトテンプレート本文・評価対象の4項目」のハッシュ
+#  ※ temperature 0.0 の評価は決定的なので、同じ入力の再評価は省略できる
+#  ※ prompts.py のテンプレートを書き換えると、そのテンプレートの結果だけが別キーになる
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+import tracing
+
+DEFAULT_MAX_ENTRIES = 200_000
+EVICT_INTERVAL = 1000  # この件数書き込むごとに上限チェックを行う
+
+
+def template_hash(template: str) -> str:
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+
+def make_key(model: str, template: str, before_response: str, userinput1: str, response1: str, log: str) -> str:
+    """
+    評価結果を一意に決める要素からキャッシュキーを作る
+    """
+    payload = json.dumps(
+        [model, template_hash(template), before_response, userinput1, response1, log],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """
+    SQLite に評価結果（LLM の生の応答テキスト）を保存するキャッシュ
+    件数が上限を超えたら最終参照が古いものから削除する
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scores (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                template_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS scores_last_access ON scores(last_access)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS scores_template ON scores(template_hash)")
+        self._conn.commit()
+        self._writes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with tracing.span("score_cache.get") as span, self._lock:
+            row = self._conn.execute("SELECT response FROM scores WHERE key = ?", (key,)).fetchone()
+            span.set_attribute("cache.hit", row is not None)
+            if row is None:
+                self._misses += 1
+                return None
+            self._conn.execute("UPDATE scores SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self._hits += 1
+            return row[0]
+
+    def put(self, key: str, model: str, template: str, response: str) -> None:
+        now = time.time()
+        with tracing.span("score_cache.put", **{"llm.model": model}), self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scores (key, model, template_hash, response, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, template_hash(template), response, now, now),
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % EVICT_INTERVAL == 0:
+                self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM scores").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_access LIMIT ?)",
+                (overflow,),
+            )
+            self._conn.commit()
+            self._evictions += overflow
+
+    def prune_templates(self, current_templates: Iterable[str]) -> int:
+        """
+        現在のテンプレートのどれにも該当しない（編集前のプロンプトの）結果を削除する
+        """
+        hashes = [template_hash(t) for t in current_templates]
+        placeholders = ",".join("?" * len(hashes))
+        with self._lock:
+            cursor = self._conn.execute(
+                f"DELETE FROM scores WHERE template_hash NOT IN ({placeholders})", hashes
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM scores").fetchone()
+            lookups = self._hits + self._misses
+            return {
+                "size": count,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
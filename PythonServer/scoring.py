@@ -0,0 +1,129 @@
+# scoring.py
+# 完了した会話ターンを 3 観点（的確性・論理性・ユーモア）でバックグラウンド評価し、結果をユーザーごとに保持する
+#  ※ submit() は待ち行列に積むだけなので、評価の待ち時間は会話の応答に加わらない
+#  ※ ワーカーの LLM 呼び出しは低優先度(scheduler.low_priority)で行い、会話の呼び出しが待っていれば後回しにする
+#  ※ 結果は /scores で取得する（評価中は status="pending"）。リセットしたユーザーの結果は捨てる
+
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import tracing
+from evaluator import EvaluationRequest, Evaluator
+from scheduler import current_user, low_priority
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 1000          # 評価待ちの上限（超えたら評価せずに status="dropped" とする）
+DEFAULT_MAX_USERS = 10_000        # 結果を保持するユーザー数の上限（古いユーザーから捨てる）
+DEFAULT_MAX_TURNS_PER_USER = 100  # 1 ユーザーあたり保持するターン数の上限
+
+
+class TurnScorer:
+    """
+    ターンの評価を待ち行列に積み、ワーカーが低優先度で順に評価する
+    start() / close() はサーバの起動・終了時にイベントループ上で呼ぶ
+    """
+
+    def __init__(self, evaluator: Evaluator, workers: int = DEFAULT_WORKERS, max_queue: int = DEFAULT_MAX_QUEUE,
+                 max_users: int = DEFAULT_MAX_USERS, max_turns_per_user: int = DEFAULT_MAX_TURNS_PER_USER):
+        self.evaluator = evaluator
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_users = max_users
+        self.max_turns_per_user = max_turns_per_user
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # user_id -> (ターン番号 -> 結果)。最後に更新されたユーザーが末尾
+        self._results: "OrderedDict[str, OrderedDict[int, Dict[str, Any]]]" = OrderedDict()
+        # user_id -> リセット回数（リセット前に積まれた評価の結果を捨てるため）
+        self._epochs: Dict[str, int] = {}
+        self._completed = 0
+        self._failed = 0
+        self._dropped = 0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        """
+        ワーカーを止める（評価待ちのターンは評価しない）
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, user_id: str, turn: int, request: EvaluationRequest) -> None:
+        """
+        ターンの評価を待ち行列に積む（ブロックしない）
+        """
+        result = self._record(user_id, turn)
+        span = tracing.current_span()
+        job = (user_id, turn, self._epochs.get(user_id, 0), request, span.trace_id if span else None)
+        try:
+            if self._queue is None:
+                raise asyncio.QueueFull
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._dropped += 1
+            result["status"] = "dropped"
+
+    def _record(self, user_id: str, turn: int) -> Dict[str, Any]:
+        turns = self._results.get(user_id)
+        if turns is None:
+            turns = self._results[user_id] = OrderedDict()
+        self._results.move_to_end(user_id)
+        while len(self._results) > self.max_users:
+            evicted, _ = self._results.popitem(last=False)
+            self._epochs.pop(evicted, None)
+        result = turns[turn] = {"turn": turn, "status": "pending"}
+        while len(turns) > self.max_turns_per_user:
+            turns.popitem(last=False)
+        return result
+
+    def reset(self, user_id: str) -> None:
+        """
+        ユーザーの結果を捨てる（評価中のターンの結果も反映しない）
+        """
+        self._results.pop(user_id, None)
+        self._epochs[user_id] = self._epochs.get(user_id, 0) + 1
+
+    def results(self, user_id: str) -> List[Dict[str, Any]]:
+        turns = self._results.get(user_id)
+        return [dict(result) for result in turns.values()] if turns else []
+
+    async def _worker(self) -> None:
+        # このタスクからの LLM 呼び出しはすべて低優先度にする
+        low_priority.set(True)
+        while True:
+            user_id, turn, epoch, request, turn_trace_id = await self._queue.get()
+            current_user.set(user_id)
+            with tracing.span("scoring.turn", **{"session.user_id": user_id, "turn": turn,
+                                                 "turn.trace_id": turn_trace_id}):
+                try:
+                    # 失敗した観点を 0 点として残さず、ターン全体を status="failed" にする
+                    scores = await self.evaluator.evaluate(request, strict=True)
+                except Exception as e:
+                    print(f"Scoring Error ({user_id}, turn {turn}): {e!r}")
+                    self._failed += 1
+                    update = {"status": "failed"}
+                else:
+                    self._completed += 1
+                    update = {"status": "done", **scores.model_dump()}
+
+            # 評価中にリセット・破棄されていたら捨てる
+            turns = self._results.get(user_id)
+            if self._epochs.get(user_id, 0) == epoch and turns is not None and turn in turns:
+                turns[turn].update(update)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "workers": len(self._tasks),
+            "completed": self._completed,
+            "failed": self._failed,
+            "dropped": self._dropped,
+            "users": len(self._results),
+        }
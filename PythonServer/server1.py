@@ -1,14 +1,29 @@
 # server1.py (Unity IF維持 + Ollama AI統合版)
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import prompts
 
-import ollama
-from typing import List, Dict
+import llm_client
+import emotion
+import moderation
+import cache
+import context
+import journal
+import metrics
+import scoring
+import tracing
+import warmup
+from evaluator import EvaluationRequest, Evaluator
+from session_store import Session, SessionStore, SQLiteSessionBackend
+from scheduler import Admission, Overloaded, current_user
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple
 import re
+import json
+import asyncio
 
 # ------------------------------------------------------------
 # Unity から飛んでくる JSON と合わせた Request/Response モデル
@@ -44,12 +59,35 @@ class ResponseReset(BaseModel):
     first_message: str
 
 
+class TurnScore(BaseModel):
+    turn: int
+    status: str  # pending / done / failed / dropped
+    relevance: Optional[int] = None  # 的確性 (1-5, 0 は評価失敗)
+    clarity: Optional[int] = None    # 論理性
+    attitude: Optional[int] = None   # ユーモア
+
+
+class ResponseScores(BaseModel):
+    user_id: str
+    scores: List[TurnScore]
+
+
 # ------------------------------------------------------------
 # FastAPI アプリ作成
 # ------------------------------------------------------------
 
 app = FastAPI()
 
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    # 混雑時はタイムアウトまで待たせず、いつ再送すればよいかを返してすぐ断る
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": "server is busy, please retry later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # Unity からのアクセスを許可（必要なら）
 app.add_middleware(
     CORSMiddleware,
@@ -58,24 +96,108 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエストごとのトレース（LLM 呼び出し・セッション操作・フォールバックをスパンとして JSONL に書き出す）
+TRACE_PATH = "traces_server1.jsonl"  # None なら書き出さない
+tracing.configure("server1", TRACE_PATH)
+app.add_middleware(tracing.TracingMiddleware, exclude_paths=("/metrics", "/ready", "/stats", "/scores"))
+
 # ------------------------------------------------------------
-# 会話履歴管理 (簡易メモリ保存)
+# 会話履歴管理 (メモリ上のセッションストア)
+#  ※ 件数・メモリ量の上限とアイドル時間で古いセッションを捨てる
+#  ※ 同じ user_id のリクエストはセッションのロックで 1 つずつ処理する
+#  ※ SESSION_DB_PATH を指定すると SQLite にも保存し、再起動・追い出し後も会話を続けられる
 # ------------------------------------------------------------
 
-chat_history_store: Dict[str, List[Dict[str, str]]] = {}
-count_store: Dict[str, int] = {}  # user_idごとの回数カウント
+MAX_SESSIONS = 10_000
+MAX_SESSION_BYTES = 256 * 1024 * 1024
+SESSION_IDLE_TTL_SECONDS = 2 * 60 * 60
+SESSION_DB_PATH = None  # 例: "sessions.sqlite3"（None ならメモリ上のみ）
+
+session_store = SessionStore(
+    max_sessions=MAX_SESSIONS,
+    max_bytes=MAX_SESSION_BYTES,
+    idle_ttl_seconds=SESSION_IDLE_TTL_SECONDS,
+    backend=SQLiteSessionBackend(SESSION_DB_PATH) if SESSION_DB_PATH else None,
+)
 
 MODEL_NAME = "hf.co/mmnga/Llama-3.1-Swallow-8B-Instruct-v0.5-gguf:latest"
 
+# 起動時に読み込んでおくモデル（/ready で準備状況を返す）
+model_warmer = warmup.ModelWarmer([MODEL_NAME])
+
+# モデレーション・表情スコアの LLM 判定結果キャッシュ
+#  ※ プロンプトを変更したら *_PROMPT_VERSION を上げて古い結果を使わないようにする
+MODERATION_PROMPT_VERSION = 1
+EMOTION_PROMPT_VERSION = 1
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 60 * 60
+
+moderation_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+emotion_cache = cache.TTLCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+
+SYSTEM_PROMPT = {
+    'role': 'system',
+    'content': 'あなたは親切で役に立つAIアシスタントです。日本語で簡潔に答えてください。'
+}
+GENERATE_ERROR_MESSAGE = "申し訳ありません。エラーが発生しました。"
+
+# 表情スコアの算出方法
+#  "llm": 毎回 LLM に問い合わせる
+#  "local": 感情語辞書によるローカル推定のみ（LLM 呼び出しなし）
+#  "hybrid": ローカル推定を優先し、自信がない場合だけ LLM に問い合わせる
+EMOTION_SCORER = "hybrid"
+
+# True にすると入力チェックと返答生成を同時に開始する（INVALID なら生成を破棄）
+SPECULATIVE_MODERATION = False
+
+# 返答生成に渡す履歴のトークン予算（システムプロンプトを除く。要約メッセージは常に含める）
+CONTEXT_TOKEN_BUDGET = 2048
+
+# 長い会話の要約：生の発言数が SUMMARY_TRIGGER_MESSAGES を超えたら、
+# 直近 SUMMARY_KEEP_MESSAGES 件を残して古い発言を要約メッセージにまとめる（応答後にバックグラウンドで実行）
+SUMMARY_TRIGGER_MESSAGES = 20
+SUMMARY_KEEP_MESSAGES = 10
+SUMMARY_HEADER = "これまでの会話の要約:\n"
+
+# 完了したターンを評価用の JSONL（evaluator.EvaluationRequest と同じ形式）に書き出す先
+# ファイルは日付・サイズごとに分かれる（None なら書き出さない）
+TRANSCRIPT_DIR = "transcripts"
+transcript_journal = journal.TranscriptJournal(TRANSCRIPT_DIR) if TRANSCRIPT_DIR else None
+
+# 完了したターンの 3 観点評価（的確性・論理性・ユーモア）をバックグラウンドで行い、/scores で返す
+#  ※ 評価の LLM 呼び出しは低優先度で、会話の呼び出しが待っていない時だけ実行される
+#  ※ 会話データは毎ターン異なるので評価キャッシュは使わない
+TURN_SCORING = True
+SCORING_WORKERS = 2
+SCORING_CONCURRENCY = 3
+turn_scorer = scoring.TurnScorer(
+    Evaluator(MODEL_NAME, cache=None, concurrency=SCORING_CONCURRENCY),
+    workers=SCORING_WORKERS,
+) if TURN_SCORING else None
+
+background_tasks: set = set()    # 実行中のバックグラウンドタスク（GC で消えないよう参照を保持）
+
 
 # ------------------------------------------------------------
 # LLM処理関数群（②から移植）
+#  ※ 共有の非同期クライアントを使い、生成待ちの間も他ユーザーを処理する
 # ------------------------------------------------------------
 
-def check_input_validity(text: str) -> bool:
+@metrics.staged("moderation")
+async def check_input_validity(text: str) -> bool:
     """
     入力文書が会話として適切かを評価する (True: 適切, False: 不適切)
+    明らかな入力はローカルの事前チェックで確定させ、LLM 呼び出しを省く
     """
+    verdict = moderation.prefilter(text)
+    if verdict is not None:
+        return verdict
+
+    cache_key = cache.make_key(MODEL_NAME, MODERATION_PROMPT_VERSION, text)
+    cached = moderation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     You are a content moderator. Analyze the following user input.
     If it contains offensive content, nonsense, or is completely inappropriate for a chat, reply with "INVALID".
@@ -85,39 +207,89 @@ def check_input_validity(text: str) -> bool:
     Answer (VALID or INVALID):
     """
     try:
-        response = ollama.chat(
+        # 判定結果はキャッシュと同様に使い回してよいので、同時に来た同じ入力のチェックは 1 回にまとめる
+        response = await llm_client.chat(
             model=MODEL_NAME,
-            messages=[{'role': 'user', 'content': prompt}]
+            messages=[{'role': 'user', 'content': prompt}],
+            coalesce=True,
         )
         content = response['message']['content'].strip().upper()
-        return "VALID" in content
+        is_valid = "VALID" in content and "INVALID" not in content
+        moderation_cache.put(cache_key, is_valid)
+        return is_valid
     except Exception as e:
         print(f"Validation Error: {e}")
+        tracing.record_fallback(e, True)
         return True  # エラー時は一旦通す安全策
 
 
-def generate_ai_response(history: List[Dict[str, str]]) -> str:
+@metrics.staged("generation")
+async def generate_ai_response(history: List[Dict[str, str]]) -> Tuple[str, bool]:
     """
     過去の会話履歴を踏まえて回答を生成する
+    戻り値は (返答, 生成に失敗してエラーメッセージを返したか)
     """
     try:
-        system_prompt = {
-            'role': 'system',
-            'content': 'あなたは親切で役に立つAIアシスタントです。日本語で簡潔に答えてください。'
-        }
-        messages = [system_prompt] + history
-
-        response = ollama.chat(model=MODEL_NAME, messages=messages)
-        return response['message']['content']
+        messages = [SYSTEM_PROMPT] + history
+
+        response = await llm_client.chat(model=MODEL_NAME, messages=messages)
+        return response['message']['content'], False
     except Exception as e:
         print(f"Generate Error: {e}")
-        return "申し訳ありません。エラーが発生しました。"
+        tracing.record_fallback(e, GENERATE_ERROR_MESSAGE)
+        return GENERATE_ERROR_MESSAGE, True
 
 
-def evaluate_emotion(text: str) -> int:
+async def stream_ai_response(history: List[Dict[str, str]],
+                             status: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    generate_ai_response のストリーミング版（生成されたトークンを順に返す）
+    生成に失敗した（エラーメッセージを返した・途中で切れた）場合は status["failed"] を True にする
+    """
+    has_output = False
+    with metrics.stage("generation"):
+        try:
+            messages = [SYSTEM_PROMPT] + history
+
+            stream = await llm_client.chat(model=MODEL_NAME, messages=messages, stream=True)
+            async for chunk in stream:
+                token = chunk['message']['content']
+                if token:
+                    has_output = True
+                    yield token
+        except Exception as e:
+            print(f"Generate Error: {e}")
+            if status is not None:
+                status["failed"] = True
+            if not has_output:
+                tracing.record_fallback(e, GENERATE_ERROR_MESSAGE)
+                yield GENERATE_ERROR_MESSAGE
+            else:
+                tracing.record_fallback(e, "truncated")
+
+
+@metrics.staged("emotion")
+async def evaluate_emotion(text: str) -> int:
     """
     回答テキストに基づいて表情用スコア(0-15)を生成する
+    EMOTION_SCORER の設定に従ってローカル推定と LLM を使い分ける
+    """
+    if EMOTION_SCORER != "llm":
+        score, confident = emotion.score_emotion(text)
+        if EMOTION_SCORER == "local" or confident:
+            return score
+    return await evaluate_emotion_llm(text)
+
+
+async def evaluate_emotion_llm(text: str) -> int:
+    """
+    回答テキストに基づいて表情用スコア(0-15)を LLM で生成する
     """
+    cache_key = cache.make_key(MODEL_NAME, EMOTION_PROMPT_VERSION, text)
+    cached = emotion_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     Analyze the sentiment of the following text and assign an integer score from 0 to 15.
     
@@ -131,22 +303,52 @@ def evaluate_emotion(text: str) -> int:
     Return ONLY the integer number. Do not explain.
     """
     try:
-        response = ollama.chat(
+        # スコアはキャッシュと同様に使い回してよいので、同時に来た同じ文のスコアは 1 回にまとめる
+        response = await llm_client.chat(
             model=MODEL_NAME,
-            messages=[{'role': 'user', 'content': prompt}]
+            messages=[{'role': 'user', 'content': prompt}],
+            coalesce=True,
         )
         content = response['message']['content'].strip()
 
         match = re.search(r'\d+', content)
         if match:
             score = int(match.group())
-            return max(0, min(15, score))
+            score = max(0, min(15, score))
+            emotion_cache.put(cache_key, score)
+            return score
+        tracing.record_fallback(f"no score in {content!r}", 7)
         return 7
     except Exception as e:
         print(f"Emotion Error: {e}")
+        tracing.record_fallback(e, 7)
         return 7
 
 
+async def moderate_and_generate(user_message: str, history: List[Dict[str, str]]) -> Tuple[Optional[str], bool]:
+    """
+    入力チェックと返答生成を行う
+    戻り値は (返答 (None: 入力が不適切), 生成に失敗してエラーメッセージを返したか)
+    SPECULATIVE_MODERATION 有効時は両方を同時に走らせ、INVALID なら生成をキャンセルする
+    """
+    if not SPECULATIVE_MODERATION:
+        if not await check_input_validity(user_message):
+            return None, False
+        return await generate_ai_response(history)
+
+    generation_task = asyncio.create_task(generate_ai_response(history))
+    try:
+        is_valid = await check_input_validity(user_message)
+    except BaseException:
+        generation_task.cancel()
+        raise
+
+    if not is_valid:
+        generation_task.cancel()
+        return None, False
+    return await generation_task
+
+
 def determine_state(user_text: str, ai_text: str) -> int:
     """
     ルールベースで状態(1-10)を決定する
@@ -161,6 +363,134 @@ def determine_state(user_text: str, ai_text: str) -> int:
     return 1
 
 
+# ------------------------------------------------------------
+# 会話履歴の要約（応答を返した後にバックグラウンドで実行）
+#  履歴の先頭を要約メッセージ 1 件に置き換えることで、
+#  セッションが長くなってもメモリとプロンプトの大きさを一定に保つ
+# ------------------------------------------------------------
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return message['role'] == 'system' and message['content'].startswith(SUMMARY_HEADER)
+
+
+def build_context(history: List[Dict[str, str]], user_entry: Dict[str, str]):
+    """
+    返答生成に渡す履歴を作る（要約メッセージ + トークン予算に収まる直近の発言）
+    戻り値は (履歴, トークン数)
+    """
+    summary = history[:1] if history and is_summary(history[0]) else []
+    messages = history[len(summary):] + [user_entry]
+    return context.assemble_context(messages, CONTEXT_TOKEN_BUDGET, pinned=summary)
+
+
+def render_conversation(messages: List[Dict[str, str]]) -> str:
+    names = {'user': 'ユーザー', 'assistant': 'アシスタント'}
+    return "\n".join(f"{names.get(m['role'], m['role'])}: {m['content']}" for m in messages)
+
+
+# ------------------------------------------------------------
+# 評価用トランスクリプト
+#  log は「これまでの会話全体」（要約済みの部分は要約文）、
+#  before_response はユーザーの発言の直前のメンター（AI）の発言（最初のターンは挨拶文）
+# ------------------------------------------------------------
+
+def render_log(history: List[Dict[str, str]]) -> str:
+    lines = []
+    if not (history and is_summary(history[0])):
+        lines.append(f"Mentor: {prompts.prompt_init.strip()}")
+    for m in history:
+        if is_summary(m):
+            lines.append(m['content'])
+        elif m['role'] == 'user':
+            lines.append(f"User: {m['content']}")
+        else:
+            lines.append(f"Mentor: {m['content']}")
+    return "\n".join(lines)
+
+
+def make_transcript(history: List[Dict[str, str]], user_message: str, reply_text: str) -> EvaluationRequest:
+    """
+    ターン追加前の履歴と今回のやり取りから、評価 1 件分のデータを作る
+    """
+    before_response = next(
+        (m['content'] for m in reversed(history) if m['role'] == 'assistant'),
+        prompts.prompt_init.strip(),
+    )
+    return EvaluationRequest(
+        before_response=before_response,
+        userinput1=user_message,
+        response1=reply_text,
+        log=render_log(history),
+    )
+
+
+@metrics.staged("summary")
+async def summarize(previous_summary: str, messages: List[Dict[str, str]]) -> Optional[str]:
+    """
+    これまでの要約と古い発言をまとめた新しい要約を作る（失敗時は None）
+    """
+    prompt = prompts.prompt_summary.format(
+        summary=previous_summary or "（なし）",
+        conversation=render_conversation(messages),
+    )
+    try:
+        response = await llm_client.chat(
+            model=MODEL_NAME,
+            messages=[{'role': 'user', 'content': prompt}]
+        )
+        return response['message']['content'].strip()
+    except Exception as e:
+        print(f"Summary Error: {e}")
+        tracing.record_fallback(e, None)
+        return None
+
+
+async def compact_history(session: Session):
+    """
+    古い発言を要約メッセージにまとめ、まとめた生の発言を履歴から取り除く
+    """
+    history = session.history
+    start = 1 if history and is_summary(history[0]) else 0
+    end = len(history) - SUMMARY_KEEP_MESSAGES
+    if end - start <= SUMMARY_TRIGGER_MESSAGES - SUMMARY_KEEP_MESSAGES:
+        return
+
+    previous_summary = history[0]['content'][len(SUMMARY_HEADER):] if start else ""
+    folded = history[start:end]
+    summary = await summarize(previous_summary, folded)
+    if summary is None:
+        return  # 次のターンで再挑戦する
+
+    async with session.lock:
+        # 要約中にリセット・破棄されていたら何もしない
+        # （履歴は末尾への追加しかされないので、まとめた範囲 [:end] は変わっていない）
+        if session_store.peek(session.user_id) is not session:
+            return
+        history[:end] = [{'role': 'system', 'content': SUMMARY_HEADER + summary}]
+        session_store.save(session)
+
+
+def schedule_compaction(session: Session):
+    """
+    履歴が長くなっていれば要約処理をバックグラウンドで開始する
+    """
+    history = session.history
+    raw_count = len(history) - (1 if history and is_summary(history[0]) else 0)
+    if raw_count <= SUMMARY_TRIGGER_MESSAGES or session.summarizing:
+        return
+
+    async def run():
+        try:
+            await compact_history(session)
+        finally:
+            session.summarizing = False
+
+    session.summarizing = True
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
 # ------------------------------------------------------------
 # Unity用の変換レイヤ
 #  emotion_score(0-15) -> face_type(0-3)
@@ -199,50 +529,56 @@ async def reset(req: RequestReset):
     user_id = req.user_id or "default"
 
     # カウントと履歴をリセット
-    count_store[user_id] = 0
-    chat_history_store[user_id] = []
+    session_store.reset(user_id)
+    if turn_scorer is not None:
+        turn_scorer.reset(user_id)
 
     return ResponseReset(result=True, first_message = prompts.prompt_init, face_type = 0)
 
 
-@app.post("/send_message", response_model=ResponseSendPlayerMessage)
-async def send_message(req: RequestSendPlayerMessage):
-    print("▼ Received from Unity:")
-    print(req.json())
+def prepare_turn(session: Session, user_message: str):
+    """
+    カウントを進め、返答生成に渡す直近履歴を組み立てる
+    （入力チェックを通るまで履歴本体には追加しない）
+    """
+    session.count += 1
 
-    user_id = req.user_id or "default"
-    user_message = req.message
+    user_entry = {'role': 'user', 'content': user_message}
+    recent_history, context_tokens = build_context(session.history, user_entry)
+    print(f"▼ Context: {len(recent_history)} messages, {context_tokens} tokens")
+    return user_entry, recent_history
 
-    # カウント初期化
-    if user_id not in count_store:
-        count_store[user_id] = 0
-    count_store[user_id] += 1
 
-    # 1) 入力チェック
-    is_valid = check_input_validity(user_message)
-    if not is_valid:
+async def complete_turn(session: Session, user_message: str, user_entry: Dict[str, str],
+                        reply_text: Optional[str], generation_failed: bool = False) -> ResponseSendPlayerMessage:
+    """
+    返答確定後の処理（履歴追加・感情スコア・状態判定）を行い Unity 向けレスポンスを作る
+    reply_text が None の場合は入力が不適切だったものとして扱う
+    generation_failed の場合（返答がエラーメッセージ）はトランスクリプトの記録・評価を行わない
+    """
+    if reply_text is None:
         reply_text = "申し訳ありませんが、その入力には回答できません。"
         emotion_score = 2
         state_code = 9
+        session_store.save(session)
     else:
-        # 2) 履歴準備
-        if user_id not in chat_history_store:
-            chat_history_store[user_id] = []
-
-        chat_history_store[user_id].append(
-            {'role': 'user', 'content': user_message}
-        )
-
-        recent_history = chat_history_store[user_id][-20:]
-
-        # 3) AI返答生成
-        reply_text = generate_ai_response(recent_history)
-        chat_history_store[user_id].append(
+        if not generation_failed:
+            transcript = make_transcript(session.history, user_message, reply_text)
+            if transcript_journal is not None:
+                transcript_journal.append(transcript.model_dump())
+            if turn_scorer is not None:
+                turn_scorer.submit(session.user_id, session.count, transcript)
+        session.history.append(user_entry)
+        session.history.append(
             {'role': 'assistant', 'content': reply_text}
         )
+        session_store.save(session)
+
+        # 古い発言の要約は応答の裏で進める
+        schedule_compaction(session)
 
         # 4) 感情スコア
-        emotion_score = evaluate_emotion(reply_text)
+        emotion_score = await evaluate_emotion(reply_text)
 
         # 5) 状態判定
         state_code = determine_state(user_message, reply_text)
@@ -255,7 +591,7 @@ async def send_message(req: RequestSendPlayerMessage):
     # - state_code==10（ユーザー終了ワード）
     # - 念のため max_message 超えたら終了（①の挙動も残す）
     max_message = 9999  # ①の3回終了を消したいなら大きく、残したいなら 3
-    end_flag = (state_code == 10) or (count_store[user_id] >= max_message)
+    end_flag = (state_code == 10) or (session.count >= max_message)
 
     return ResponseSendPlayerMessage(
         message=reply_text,
@@ -265,6 +601,199 @@ async def send_message(req: RequestSendPlayerMessage):
     )
 
 
+@app.post("/send_message", response_model=ResponseSendPlayerMessage)
+@metrics.staged("turn")
+async def send_message(req: RequestSendPlayerMessage):
+    print("▼ Received from Unity:")
+    print(req.json())
+
+    user_id = req.user_id or "default"
+    user_message = req.message
+
+    # 混雑していれば受け付けずに 429/503 を返す
+    admission = llm_client.scheduler.admit(user_id)
+    current_user.set(user_id)
+
+    # 同じユーザーのリクエストが重なっても履歴の順序が崩れないよう、1 つずつ処理する
+    session = session_store.get(user_id)
+    with admission:
+        async with session.lock:
+            # 1) 履歴準備
+            user_entry, recent_history = prepare_turn(session, user_message)
+
+            # 2) 入力チェック + 3) AI返答生成
+            reply_text, generation_failed = await moderate_and_generate(user_message, recent_history)
+
+            return await complete_turn(session, user_message, user_entry, reply_text, generation_failed)
+
+
+@app.get("/stats")
+async def stats():
+    """
+    サーバ内部の統計情報を返す
+    """
+    return {
+        "moderation_prefilter": moderation.stats(),
+        "moderation_cache": moderation_cache.stats(),
+        "emotion_cache": emotion_cache.stats(),
+        "context": context.stats(),
+        "sessions": session_store.stats(),
+        "scheduler": llm_client.scheduler.stats(),
+        "llm": llm_client.stats(),
+        "journal": transcript_journal.stats() if transcript_journal is not None else None,
+        "scoring": turn_scorer.stats() if turn_scorer is not None else None,
+    }
+
+
+@app.get("/scores", response_model=ResponseScores)
+async def get_scores(user_id: str = "default"):
+    """
+    ターンごとの 3 観点評価（バックグラウンドで評価中のターンは status="pending"）を返す
+    Unity 側はこれを定期的に問い合わせる
+    """
+    results = turn_scorer.results(user_id) if turn_scorer is not None else []
+    return ResponseScores(user_id=user_id, scores=[TurnScore(**result) for result in results])
+
+
+def collect_metrics():
+    yield from metrics.cache_samples("moderation", moderation_cache.stats())
+    yield from metrics.cache_samples("emotion", emotion_cache.stats())
+    yield from metrics.session_samples(session_store.stats())
+
+
+metrics.add_collector(collect_metrics)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    処理段階ごとの所要時間・トークン数・キュー長・キャッシュ・セッション数を Prometheus 形式で返す
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+def to_ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+async def stream_turn(session: Session, user_message: str, user_entry: Dict[str, str],
+                      recent_history: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    1 ターン分の NDJSON 行を順に返す（トークン行 ... 最終行）
+    """
+    token_queue: asyncio.Queue = asyncio.Queue()
+    status = {"failed": False}
+
+    async def produce():
+        async for token in stream_ai_response(recent_history, status):
+            await token_queue.put(token)
+        await token_queue.put(None)
+
+    # 投機モードでは入力チェック中に生成を先行させ、トークンは確定まで溜めておく
+    producer = asyncio.create_task(produce()) if SPECULATIVE_MODERATION else None
+    try:
+        if not await check_input_validity(user_message):
+            if producer is not None:
+                producer.cancel()
+            final = await complete_turn(session, user_message, user_entry, None)
+            yield to_ndjson({"type": "final", **final.model_dump()})
+            return
+
+        if producer is None:
+            producer = asyncio.create_task(produce())
+
+        tokens = []
+        while (token := await token_queue.get()) is not None:
+            tokens.append(token)
+            yield to_ndjson({"type": "token", "message": token})
+
+        final = await complete_turn(session, user_message, user_entry, "".join(tokens), status["failed"])
+        yield to_ndjson({"type": "final", **final.model_dump()})
+    finally:
+        # クライアント切断時などに生成を止める
+        if producer is not None and not producer.done():
+            producer.cancel()
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    送信が終わったら受付(Admission)を解放する StreamingResponse
+    （本文を送り始める前にクライアントが切断し、ジェネレータが一度も動かなかった場合の取りこぼし防止）
+    """
+
+    def __init__(self, content, admission: Admission, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.release()
+
+
+@app.post("/send_message_stream")
+async def send_message_stream(req: RequestSendPlayerMessage):
+    """
+    /send_message のストリーミング版 (NDJSON)
+    返答トークンを {"type": "token", "message": ...} として生成され次第送り、
+    最後に {"type": "final", ...ResponseSendPlayerMessage} を送る
+    """
+    print("▼ Received from Unity (stream):")
+    print(req.json())
+
+    user_id = req.user_id or "default"
+    user_message = req.message
+
+    # 混雑していれば受け付けずに 429/503 を返す（ストリーム開始前に判定し、この時点から処理中として数える）
+    admission = llm_client.scheduler.admit(user_id)
+
+    async def event_stream():
+        current_user.set(user_id)
+        # セッションはロックを取る直前に取り出す（ストリーム開始までの間に追い出し・リセットされた
+        # 古いセッションに書き込まないように）
+        session = session_store.get(user_id)
+        # ストリーム送信中もセッションのロックを保持し、同じユーザーの次のターンを待たせる
+        with admission:
+            async with session.lock:
+                user_entry, recent_history = prepare_turn(session, user_message)
+                async for line in stream_turn(session, user_message, user_entry, recent_history):
+                    yield line
+
+    return AdmittedStreamingResponse(event_stream(), admission, media_type="application/x-ndjson")
+
+
+@app.get("/ready")
+async def ready():
+    """
+    モデルの読み込みが終わっていれば 200、そうでなければ 503 を返す（ロードバランサ用）
+    """
+    return JSONResponse(
+        status_code=200 if model_warmer.is_ready() else 503,
+        content=model_warmer.status(),
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    # モデルを読み込んでからリクエストを受け付ける
+    await model_warmer.warm_up()
+    if turn_scorer is not None:
+        turn_scorer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if turn_scorer is not None:
+        await turn_scorer.close()
+    # 書き出し待ちのセッション・トランスクリプト・スパンを保存してから終了する
+    session_store.close()
+    if transcript_journal is not None:
+        await transcript_journal.close()
+    await llm_client.close()
+    tracing.shutdown()
+
+
 # ------------------------------------------------------------
 # アプリ起動
 # ------------------------------------------------------------
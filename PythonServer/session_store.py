@@ -0,0 +1,297 @@
+# session_store.py
+# ユーザーごとの会話状態（履歴・カウンタ・終了フラグ）を管理するセッションストア
+#  ※ 件数とメモリ量に上限を設け、長く使われていないセッションから捨てる(LRU / アイドル TTL)
+#  ※ セッションごとに asyncio.Lock を持ち、同じユーザーの重なったリクエストを順番に処理する
+#  ※ SQLiteSessionBackend を渡すと状態を SQLite にも書き出し（書き込みはバックグラウンドでまとめて行う）、
+#    再起動後やメモリから追い出された後も最初のアクセス時に読み戻す
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import tracing
+
+DEFAULT_MAX_SESSIONS = 10_000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_IDLE_TTL_SECONDS = 2 * 60 * 60
+
+# 書き出し待ちの状態をまとめて SQLite に書き込む間隔
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.5
+
+# 1 発言あたりの dict・文字列オブジェクト分のおおよそのオーバーヘッド
+MESSAGE_OVERHEAD_BYTES = 300
+SESSION_OVERHEAD_BYTES = 1024
+
+
+class Session:
+    """
+    1 ユーザー分の会話状態
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.history: List[Dict[str, str]] = []
+        self.count = 0          # 受け取ったメッセージ数
+        self.turn_count = 0     # 返答を生成した回数
+        self.end_flag = False
+        self.summarizing = False
+        self.lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+        self.size_bytes = SESSION_OVERHEAD_BYTES
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "history": self.history,
+            "count": self.count,
+            "turn_count": self.turn_count,
+            "end_flag": self.end_flag,
+        }
+
+    @classmethod
+    def from_state(cls, user_id: str, state: Dict[str, Any]) -> "Session":
+        session = cls(user_id)
+        session.history = state.get("history", [])
+        session.count = state.get("count", 0)
+        session.turn_count = state.get("turn_count", 0)
+        session.end_flag = state.get("end_flag", False)
+        session.size_bytes = session.estimate_bytes()
+        return session
+
+    def estimate_bytes(self) -> int:
+        """
+        履歴が使っているおおよそのメモリ量を返す
+        """
+        return SESSION_OVERHEAD_BYTES + sum(
+            len(m['content'].encode('utf-8')) + MESSAGE_OVERHEAD_BYTES for m in self.history
+        )
+
+
+class SQLiteSessionBackend:
+    """
+    セッションの状態を SQLite(WAL) に保存するバックエンド
+    save() は書き出し待ちに積むだけで、専用スレッドが一定間隔でまとめて書き込む（write-behind）
+    """
+
+    def __init__(self, path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # 読み込み用（呼び出し元スレッド）と書き込み用（書き込みスレッド）で接続を分ける
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.execute("PRAGMA journal_mode=WAL")
+        self._reader.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._reader.commit()
+
+        self._pending: Dict[str, Optional[str]] = {}  # user_id -> JSON（None は削除）
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writes = 0
+        self._flushes = 0
+        self._writer = threading.Thread(target=self._run_writer, name="session-writer", daemon=True)
+        self._writer.start()
+
+    def load(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        保存済みの状態を返す（書き出し待ちのものがあればそちらを優先する）
+        """
+        with self._pending_lock:
+            if user_id in self._pending:
+                raw = self._pending[user_id]
+                return None if raw is None else json.loads(raw)
+        row = self._reader.execute("SELECT state FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save(self, user_id: str, state: Dict[str, Any]) -> None:
+        raw = json.dumps(state, ensure_ascii=False)
+        with self._pending_lock:
+            self._pending[user_id] = raw
+
+    def delete(self, user_id: str) -> None:
+        with self._pending_lock:
+            self._pending[user_id] = None
+
+    def _run_writer(self) -> None:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush(conn)
+            if self._closed:
+                break
+        conn.close()
+
+    def _flush(self, conn: sqlite3.Connection) -> None:
+        with self._pending_lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+
+        now = time.time()
+        upserts = [(user_id, raw, now) for user_id, raw in batch.items() if raw is not None]
+        deletes = [(user_id,) for user_id, raw in batch.items() if raw is None]
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO sessions (user_id, state, updated_at) VALUES (?, ?, ?)", upserts)
+                conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+        except sqlite3.Error as e:
+            print(f"Session Write Error: {e}")
+            # 書き込めなかった分は、その間に新しい状態が積まれていなければ戻して次回に再挑戦する
+            with self._pending_lock:
+                for user_id, raw in batch.items():
+                    self._pending.setdefault(user_id, raw)
+            return
+        self._writes += len(batch)
+        self._flushes += 1
+
+    def close(self) -> None:
+        """
+        書き出し待ちをすべて書き込んでから停止する
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self._reader.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"pending": pending, "writes": self._writes, "flushes": self._flushes}
+
+
+class SessionStore:
+    """
+    user_id -> Session の対応を保持する（最後に使われた順に並べた OrderedDict）
+    backend を渡した場合、メモリに無いセッションは最初のアクセス時に backend から読み戻す
+    """
+
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS, max_bytes: int = DEFAULT_MAX_BYTES,
+                 idle_ttl_seconds: float = DEFAULT_IDLE_TTL_SECONDS,
+                 backend: Optional[SQLiteSessionBackend] = None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.backend = backend
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._total_bytes = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, user_id: str) -> Session:
+        """
+        セッションを取り出す（無ければ作る）
+        """
+        session = self._sessions.get(user_id)
+        if session is None:
+            with tracing.span("session_store.load", **{"session.user_id": user_id}) as span:
+                state = self.backend.load(user_id) if self.backend is not None else None
+                span.set_attribute("session.found", state is not None)
+            session = Session(user_id) if state is None else Session.from_state(user_id, state)
+            self._sessions[user_id] = session
+            self._total_bytes += session.size_bytes
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_access = time.monotonic()
+        self._evict(keep=user_id)
+        return session
+
+    def peek(self, user_id: str) -> Optional[Session]:
+        """
+        セッションがあれば返す（作成・最終利用時刻の更新はしない）
+        """
+        return self._sessions.get(user_id)
+
+    def reset(self, user_id: str) -> Session:
+        """
+        セッションを新しいものに置き換える
+        （処理中のリクエストは古いセッションに書き込むので、新しいセッションには影響しない）
+        """
+        with tracing.span("session_store.reset", **{"session.user_id": user_id}):
+            self.discard(user_id)
+            if self.backend is not None:
+                self.backend.delete(user_id)
+        session = Session(user_id)
+        self._sessions[user_id] = session
+        self._total_bytes += session.size_bytes
+        return session
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
+
+    def discard(self, user_id: str) -> None:
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            self._total_bytes -= session.size_bytes
+
+    def save(self, session: Session) -> None:
+        """
+        履歴・カウンタを変更した後に呼び、メモリ量の集計を更新して backend に書き出す
+        （リセット・破棄済みの古いセッションは何もしない）
+        """
+        if self._sessions.get(session.user_id) is not session:
+            return
+        with tracing.span("session_store.save", **{"session.user_id": session.user_id,
+                                                   "session.messages": len(session.history)}):
+            if self.backend is not None:
+                self.backend.save(session.user_id, session.to_state())
+        new_size = session.estimate_bytes()
+        self._total_bytes += new_size - session.size_bytes
+        session.size_bytes = new_size
+        self._evict(keep=session.user_id)
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """
+        アイドル時間切れのセッションと、上限を超えた分の古いセッションを捨てる
+        （処理中＝ロック中のセッションと keep のセッションは捨てない）
+        """
+        now = time.monotonic()
+        expired = []
+        for user_id, session in self._sessions.items():
+            if now - session.last_access < self.idle_ttl_seconds:
+                break  # 以降はより新しいセッションなので打ち切り
+            if user_id != keep and not session.lock.locked():
+                expired.append(user_id)
+        for user_id in expired:
+            self.discard(user_id)
+        self._expirations += len(expired)
+
+        count = len(self._sessions)
+        total_bytes = self._total_bytes
+        overflow = []
+        for user_id, session in self._sessions.items():
+            if count <= self.max_sessions and total_bytes <= self.max_bytes:
+                break
+            if user_id == keep or session.lock.locked():
+                continue
+            overflow.append(user_id)
+            count -= 1
+            total_bytes -= session.size_bytes
+        for user_id in overflow:
+            self.discard(user_id)
+        self._evictions += len(overflow)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "active_sessions": sum(1 for s in self._sessions.values() if s.lock.locked()),
+            "bytes": self._total_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+            **({"backend": self.backend.stats()} if self.backend is not None else {}),
+        }
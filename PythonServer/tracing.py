@@ -0,0 +1,308 @@
+# tracing.py
+# リクエストごとにトレース ID を振り、LLM 呼び出し・ストア操作などを子スパンとして記録する
+#  ※ スパンは OTLP/JSON 形式（OpenTelemetry Collector の file exporter と同じ 1 行 1 バッチ）で
+#    JSONL ファイルに書き出すので、otlpjsonfile receiver 等を通して Jaeger などのビューアで見られる
+#  ※ 書き出しは専用スレッドでまとめて行い、リクエスト処理は待たせない（ファイルはサイズで世代交代する）
+#  ※ 例外を握りつぶして既定値を返す箇所（フォールバック）は record_fallback() でスパンに残す
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+FLUSH_INTERVAL_SECONDS = 1.0
+MAX_BATCH_SPANS = 512
+
+# OTLP の SpanKind / StatusCode
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """
+    1 区間分の記録（開始・終了時刻、属性、イベント、結果）
+    """
+
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_span_id", "start_ns", "end_ns",
+                 "attributes", "events", "status_code", "status_message")
+
+    def __init__(self, name: str, parent: Optional["Span"], kind: int, attributes: Dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else ""
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.events: List[Dict[str, Any]] = []
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes: Any) -> None:
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def set_error(self, message: str) -> None:
+        self.status_code = STATUS_ERROR
+        self.status_message = message
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [
+                {"timeUnixNano": str(e["time_ns"]), "name": e["name"], "attributes": _otlp_attributes(e["attributes"])}
+                for e in self.events
+            ],
+            "status": {"code": self.status_code, **({"message": self.status_message} if self.status_message else {})},
+        }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+class JsonlExporter:
+    """
+    終了したスパンを専用スレッドでまとめて JSONL ファイルに書き出す
+    ファイルが max_bytes を超えたら path.1, path.2, ... と世代交代する
+    """
+
+    def __init__(self, path: str, service_name: str, max_bytes: int = DEFAULT_MAX_BYTES,
+                 backup_count: int = DEFAULT_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._resource = {"attributes": _otlp_attributes({"service.name": service_name})}
+        self._queue: "queue.SimpleQueue[Optional[Span]]" = queue.SimpleQueue()
+        self._dropped = 0
+        self._exported = 0
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def export(self, span: Span) -> None:
+        self._queue.put(span)
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            batch: List[Span] = []
+            try:
+                item = self._queue.get(timeout=FLUSH_INTERVAL_SECONDS)
+            except queue.Empty:
+                continue
+            while True:
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+                if len(batch) >= MAX_BATCH_SPANS:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[Span]) -> None:
+        line = json.dumps({
+            "resourceSpans": [{
+                "resource": self._resource,
+                "scopeSpans": [{"scope": {"name": "LlamaCommunicationTraining"},
+                                "spans": [span.to_otlp() for span in batch]}],
+            }]
+        }, ensure_ascii=False) + "\n"
+        try:
+            self._rotate_if_needed(len(line.encode("utf-8")))
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self._exported += len(batch)
+        except OSError as e:
+            print(f"Trace Export Error: {e}")
+            self._dropped += len(batch)
+
+    def _rotate_if_needed(self, incoming: int) -> None:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size + incoming <= self.max_bytes:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def close(self) -> None:
+        """
+        書き出し待ちのスパンをすべて書き込んでから停止する
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {"exported": self._exported, "dropped": self._dropped}
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_exporter: Optional[JsonlExporter] = None
+
+
+def configure(service_name: str, path: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES,
+              backup_count: int = DEFAULT_BACKUP_COUNT) -> None:
+    """
+    スパンの書き出し先を設定する（path が None なら書き出さない）
+    """
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = JsonlExporter(path, service_name, max_bytes, backup_count) if path else None
+
+
+def shutdown() -> None:
+    if _exporter is not None:
+        _exporter.close()
+
+
+def start_span(name: str, kind: int = KIND_INTERNAL, **attributes: Any) -> Span:
+    """
+    現在のスパンの子スパンを作る（現在のスパンにはしない。終わったら end_span() を呼ぶ）
+    ストリームのように、開始と終了が 1 つの with に収まらない区間に使う
+    """
+    return Span(name, _current.get(), kind, attributes)
+
+
+def record_exception(target: Span, e: BaseException) -> None:
+    target.set_error(repr(e))
+    target.add_event("exception", **{"exception.type": type(e).__name__, "exception.message": str(e)})
+
+
+def end_span(target: Span) -> None:
+    target.end_ns = time.time_ns()
+    if target.status_code == STATUS_UNSET:
+        target.status_code = STATUS_OK
+    if _exporter is not None:
+        _exporter.export(target)
+
+
+@contextmanager
+def use_span(target: Span):
+    """
+    with の間だけ target を現在のスパンにする
+    """
+    token = _current.set(target)
+    try:
+        yield target
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes: Any):
+    """
+    現在のスパンの子スパンを作る（現在のスパンが無ければ新しいトレースを始める）
+    中で例外が出たらスパンを ERROR にして例外はそのまま投げ直す
+    """
+    current = start_span(name, kind, **attributes)
+    try:
+        with use_span(current):
+            yield current
+    except BaseException as e:
+        record_exception(current, e)
+        raise
+    finally:
+        end_span(current)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def set_attribute(key: str, value: Any) -> None:
+    current = _current.get()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def add_event(name: str, **attributes: Any) -> None:
+    current = _current.get()
+    if current is not None:
+        current.add_event(name, **attributes)
+
+
+def record_fallback(reason: Any, value: Any) -> None:
+    """
+    エラー等で既定値を返す（処理は続行する）ことを現在のスパンに記録する
+    """
+    current = _current.get()
+    if current is None:
+        return
+    current.set_error(f"fallback: {reason!r}")
+    current.set_attribute("fallback", True)
+    current.set_attribute("fallback.value", repr(value))
+    current.add_event("fallback", reason=repr(reason), value=repr(value))
+
+
+class TracingMiddleware:
+    """
+    HTTP リクエストごとにルートスパンを作る ASGI ミドルウェア
+    レスポンスヘッダ X-Trace-Id でトレース ID を返す（ストリーミングは送信完了までをスパンに含める）
+    """
+
+    def __init__(self, app, exclude_paths=("/metrics", "/ready", "/stats")):
+        self.app = app
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+
+        with span(f"{scope['method']} {scope['path']}", kind=KIND_SERVER,
+                  **{"http.method": scope["method"], "http.route": scope["path"]}) as root:
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    root.set_attribute("http.status_code", status)
+                    if status >= 500:
+                        root.set_error(f"HTTP {status}")
+                    message = {**message, "headers": list(message.get("headers", []))
+                               + [(b"x-trace-id", root.trace_id.encode())]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
@@ -0,0 +1,68 @@
+# warmup.py
+# サーバ起動時に使用するモデルを Ollama に読み込ませ(ウォームアップ)、準備状況を /ready で返す
+#  ※ 起動直後の最初のリクエストがモデルの読み込み時間を払わないようにする
+#  ※ keep_alive を指定して読み込むので、しばらく使われなくてもモデルはメモリに残る
+#  ※ 複数ホスト構成では全ホストに読み込ませ、1 台以上で読み込めていれば ready とする
+#    （llm_client を使わないサーバは loader で読み込み方法を差し替える）
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+import llm_client
+
+WARMUP_TIMEOUT_SECONDS = 300
+
+# (モデル名, keep_alive) を受け取り、ホスト -> 例外（成功なら None）を返す読み込み関数
+Loader = Callable[[str, str], Awaitable[Dict[str, Optional[Exception]]]]
+
+
+class ModelWarmer:
+    """
+    モデルごとのウォームアップ状態（pending / loading / ready / failed）と所要時間を保持する
+    """
+
+    def __init__(self, models: Iterable[str], keep_alive: str = llm_client.KEEP_ALIVE,
+                 timeout: float = WARMUP_TIMEOUT_SECONDS, loader: Loader = llm_client.load_model):
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.loader = loader
+        # 同じモデルを複数の役割で使っている場合は 1 回だけ読み込む
+        self._models: Dict[str, Dict[str, Any]] = {
+            model: {"status": "pending", "latency_seconds": None} for model in dict.fromkeys(models)
+        }
+
+    async def warm_up(self) -> None:
+        """
+        すべてのモデルを並行して読み込む（失敗してもサーバは起動し、/ready が 503 を返す）
+        """
+        await asyncio.gather(*(self._warm(model) for model in self._models))
+
+    async def _warm(self, model: str) -> None:
+        state = self._models[model]
+        state["status"] = "loading"
+        started = time.monotonic()
+        try:
+            results = await asyncio.wait_for(
+                self.loader(model, self.keep_alive),
+                timeout=self.timeout,
+            )
+        except Exception as e:
+            print(f"Warm-up Error ({model}): {e!r}")
+            state["status"] = "failed"
+            state["error"] = repr(e)
+        else:
+            state["hosts"] = {host: "ready" if e is None else repr(e) for host, e in results.items()}
+            for host, e in results.items():
+                if e is not None:
+                    print(f"Warm-up Error ({model} @ {host}): {e!r}")
+            state["status"] = "ready" if any(e is None for e in results.values()) else "failed"
+            state.pop("error", None)
+        state["latency_seconds"] = round(time.monotonic() - started, 3)
+        print(f"Warm-up {model}: {state['status']} ({state['latency_seconds']}s)")
+
+    def is_ready(self) -> bool:
+        return all(state["status"] == "ready" for state in self._models.values())
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.is_ready(), "models": self._models}